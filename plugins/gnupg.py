@@ -7,8 +7,6 @@ __description__ = _("Core GnuPG functions: access to public keyring, "
 __version__ = "2010-05-29"
 __author__ = "Karol Będkowski <karol.bedkowski@gmail.com>"
 
-import subprocess
-
 from kupfer import uiutils
 from kupfer import utils
 from kupfer.obj.base import Action
@@ -16,6 +14,7 @@ from kupfer.obj.objects import TextLeaf
 from kupfer.obj import contacts
 
 import gnupg_support as support
+import gnupg_backend as backend
 
 PublicKeysSource = support.PublicKeysSource
 
@@ -25,13 +24,11 @@ class ImportPubKey(Action):
         Action.__init__(self, _("Import Public Key"))
 
     def activate(self, leaf):
-        p = subprocess.Popen(
-            ["gpg", "--import"],
-            stdout=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate(leaf.object)
-        uiutils.show_notification(_("Import Public Key"), stdout or stderr)
+        try:
+            message = backend.get_backend().import_key(leaf.object)
+        except backend.GPGError as err:
+            message = backend.error_text(err)
+        uiutils.show_notification(_("Import Public Key"), message)
 
     def item_types(self):
         yield TextLeaf
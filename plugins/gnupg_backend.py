@@ -0,0 +1,549 @@
+# -*- coding: UTF-8 -*-
+''' GnuPG crypto backends.
+
+All GnuPG operations of gnupg plugins go through backend returned by
+get_backend(). GPGME Python bindings (module `gpg`) are used when available;
+otherwise gpg is run as subprocess. Both backends raise GPGError on failure.
+
+File operations take list of paths and return list of (path, error message)
+for files that failed; output files are named like gpg does (file.sig,
+file.gpg, decrypted file without extension).
+'''
+
+__version__ = "2026-10-19"
+__author__ = "Karol Będkowski <karol.bedkowski@gmail.com>"
+
+import os
+import subprocess
+import threading
+from collections import namedtuple
+
+try:
+    import gpg
+except ImportError:
+    gpg = None
+
+# use GPGME bindings when available
+USE_GPGME = True
+# extensions removed from decrypted files names
+DECRYPT_EXTENSIONS = ('.gpg', '.pgp', '.asc', '.sig')
+CLEARSIGN_HEADER = b'-----BEGIN PGP SIGNED MESSAGE-----'
+SIGNATURE_HEADER = b'-----BEGIN PGP SIGNATURE-----'
+# OpenPGP packet tag of signature packet (RFC 4880, 4.3)
+_SIGNATURE_PACKET_TAG = 2
+
+# signature verification status
+SIG_GOOD = 'good'
+SIG_BAD = 'bad'
+SIG_EXPIRED = 'expired'
+SIG_EXPIRED_KEY = 'expired-key'
+SIG_REVOKED_KEY = 'revoked-key'
+SIG_NO_KEY = 'no-key'
+SIG_ERROR = 'error'
+
+
+class GPGError(Exception):
+    pass
+
+
+# result of verification of one signature; trust is validity of signer uid
+# ('undefined', 'never', 'marginal', 'fully', 'ultimate') or None, message
+# is error message for SIG_ERROR
+Signature = namedtuple('Signature', 'status keyid fingerprint uid timestamp '
+                       'trust message')
+
+
+def _signature(status, keyid=None, fingerprint=None, uid=None,
+               timestamp=None, trust=None, message=None):
+    return Signature(status, keyid, fingerprint, uid, timestamp, trust,
+                     message)
+
+
+# gpg --status-fd keywords starting new signature
+_STATUS_SIGNATURES = {
+    'GOODSIG': SIG_GOOD,
+    'BADSIG': SIG_BAD,
+    'EXPSIG': SIG_EXPIRED,
+    'EXPKEYSIG': SIG_EXPIRED_KEY,
+    'REVKEYSIG': SIG_REVOKED_KEY,
+}
+# ERRSIG return code for missing public key
+_ERRSIG_NO_PUBKEY = '9'
+
+
+def parse_verify_status(lines, stderr=None):
+    ''' Parse gpg --status-fd output of --verify; return tuple of
+    Signature. When no signature is found, return one SIG_ERROR Signature
+    with `stderr` as message. '''
+    sigs = []
+    current = None
+    for line in lines:
+        line = to_text(line).rstrip('\r\n')
+        if not line.startswith('[GNUPG:] '):
+            continue
+        fields = line[9:].split(' ')
+        keyword = fields[0]
+        if keyword == 'NEWSIG':
+            current = None
+        elif keyword in _STATUS_SIGNATURES:
+            current = {'status': _STATUS_SIGNATURES[keyword],
+                       'keyid': fields[1] if len(fields) > 1 else None,
+                       'uid': _unescape_status(' '.join(fields[2:]))}
+            sigs.append(current)
+        elif keyword == 'ERRSIG':
+            no_key = len(fields) > 6 and fields[6] == _ERRSIG_NO_PUBKEY
+            current = {'status': SIG_NO_KEY if no_key else SIG_ERROR,
+                       'keyid': fields[1] if len(fields) > 1 else None}
+            if len(fields) > 5 and fields[5].isdigit():
+                current['timestamp'] = int(fields[5])
+            if len(fields) > 7 and fields[7] != '-':
+                current['fingerprint'] = fields[7]
+            sigs.append(current)
+        elif keyword == 'NO_PUBKEY' and current is not None:
+            current['status'] = SIG_NO_KEY
+        elif keyword == 'VALIDSIG' and current is not None:
+            # prefer fingerprint of primary key
+            current['fingerprint'] = fields[10] if len(fields) > 10 \
+                else fields[1]
+            if len(fields) > 3 and fields[3].isdigit():
+                current['timestamp'] = int(fields[3])
+        elif keyword.startswith('TRUST_') and current is not None:
+            current['trust'] = keyword[6:].lower()
+    if not sigs:
+        return (_signature(SIG_ERROR, message=to_text(stderr or '').strip()
+                           or _("No signature found")), )
+    return tuple(_signature(**sig) for sig in sigs)
+
+
+def _unescape_status(value):
+    ''' Decode %XX escapes in status-fd line '''
+    if '%' not in value:
+        return value
+    parts = value.split('%')
+    result = [parts[0]]
+    for part in parts[1:]:
+        try:
+            result.append(chr(int(part[:2], 16)) + part[2:])
+        except ValueError:
+            result.append('%' + part)
+    return ''.join(result)
+
+
+def to_bytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode('utf-8')
+
+
+def to_text(data):
+    if isinstance(data, bytes):
+        return data.decode('utf-8', 'replace')
+    return data
+
+
+def error_text(err):
+    ''' Message of exception `err` as text. str() can not be used because
+    messages of gpg are localized and str() of unicode message fails in
+    Python 2. '''
+    if len(err.args) == 1 and isinstance(err.args[0], (bytes, type(u''))):
+        return to_text(err.args[0])
+    return to_text(str(err))
+
+
+def decrypted_file_name(path):
+    ''' Name of file created by decrypting `path` or None '''
+    base, ext = os.path.splitext(path)
+    if ext.lower() in DECRYPT_EXTENSIONS:
+        return base
+    return None
+
+
+def detached_data_file(path):
+    ''' Data file signed by detached signature `path` or None '''
+    datafile = decrypted_file_name(path)
+    if datafile and os.path.isfile(datafile) and \
+            is_detached_signature(path):
+        return datafile
+    return None
+
+
+def is_detached_signature(path):
+    ''' Check if `path` contains only signature (armored or binary), not
+    signed or encrypted message '''
+    try:
+        with open(path, 'rb') as infile:
+            head = infile.read(len(SIGNATURE_HEADER) + 64)
+    except IOError:
+        return False
+    if not head:
+        return False
+    if head.lstrip().startswith(SIGNATURE_HEADER):
+        return True
+    ctb = bytearray(head[:1])[0]
+    if not ctb & 0x80:
+        # not binary OpenPGP data
+        return False
+    if ctb & 0x40:
+        # new format packet
+        tag = ctb & 0x3f
+    else:
+        tag = (ctb & 0x3c) >> 2
+    return tag == _SIGNATURE_PACKET_TAG
+
+
+def is_clearsigned(path):
+    ''' Check if `path` is clearsigned text file '''
+    try:
+        with open(path, 'rb') as infile:
+            return infile.read(len(CLEARSIGN_HEADER)) == CLEARSIGN_HEADER
+    except IOError:
+        return False
+
+
+def _file_stamp(path):
+    ''' Identity of file `path` (inode, size, mtime) or None when it not
+    exists '''
+    if not path:
+        return None
+    try:
+        fstat = os.stat(path)
+    except OSError:
+        return None
+    return fstat.st_ino, fstat.st_size, fstat.st_mtime
+
+
+class _SubprocessBackend(object):
+    ''' Run gpg process for each operation '''
+    name = 'gpg'
+    # gpg can process many files in one run for these operations
+    multiple_files = ('encrypt', 'decrypt')
+
+    def _popen(self, args, stdin=None):
+        cli = ['gpg', '--batch']
+        cli.extend(args)
+        try:
+            proc = subprocess.Popen(
+                cli,
+                stdout=subprocess.PIPE,
+                stdin=subprocess.PIPE if stdin is not None else None,
+                stderr=subprocess.PIPE)
+            stdout, stderr = proc.communicate(stdin)
+        except OSError as err:
+            raise GPGError(_("Error when running GPG: %s") % error_text(err))
+        return proc.returncode, stdout, stderr
+
+    def _run(self, args, stdin=None):
+        returncode, stdout, stderr = self._popen(args, stdin)
+        if returncode:
+            raise GPGError(to_text(stderr).strip() or
+                           _("GPG exited with code %d") % returncode)
+        return stdout, stderr
+
+    def sign(self, data, key=None):
+        args = ['--clearsign']
+        if key:
+            args.extend(('--local-user', key))
+        return self._run(args, to_bytes(data))[0]
+
+    def encrypt(self, data, recipients, sign=False):
+        args = ['--sign', '--encrypt'] if sign else ['--encrypt']
+        args.append('--armor')
+        args.extend(_recipients_params(recipients))
+        return self._run(args, to_bytes(data))[0]
+
+    def encrypt_symmetric(self, data):
+        return self._run(['--symmetric', '--armor'], to_bytes(data))[0]
+
+    def decrypt(self, data):
+        return self._run(['--decrypt'], to_bytes(data))[0]
+
+    def verify(self, data):
+        ''' Verify signed text; return tuple of Signature '''
+        return self._verify(['--verify'], to_bytes(data))
+
+    def verify_file(self, path, datafile=None):
+        ''' Verify signed or detached signature file; return tuple of
+        Signature. Data file of detached signature is found by name when
+        `datafile` is not given. '''
+        datafile = datafile or detached_data_file(path)
+        # data file must be given explicitly; otherwise gpg may read it
+        # from stdin
+        args = ['--verify', path]
+        if datafile:
+            args.append(datafile)
+        return self._verify(args, None)
+
+    def _verify(self, args, stdin):
+        try:
+            _returncode, stdout, stderr = self._popen(
+                ['--status-fd', '1'] + args, stdin)
+        except GPGError as err:
+            return (_signature(SIG_ERROR, message=error_text(err)), )
+        return parse_verify_status(stdout.splitlines(), stderr)
+
+    def export_key(self, keyid):
+        key = self._run(['--export', '--armor', keyid])[0]
+        if not key:
+            raise GPGError(_("Key %s not found") % keyid)
+        return key
+
+    def import_key(self, data):
+        ''' Import keys; return gpg message '''
+        stdout, stderr = self._run(['--import'], to_bytes(data))
+        return to_text(stdout or stderr).strip()
+
+    def sign_files(self, paths, key=None):
+        args = ['--detach-sign']
+        if key:
+            args.extend(('--local-user', key))
+        return self._each_file(args, paths)
+
+    def encrypt_files(self, paths, recipients, sign=False):
+        recipients = list(_recipients_params(recipients))
+        if sign:
+            return self._each_file(['--sign', '--encrypt'] + recipients,
+                                   paths)
+        return self._many_files(['--encrypt-files'] + recipients, paths,
+                                lambda path: path + '.gpg')
+
+    def encrypt_files_symmetric(self, paths):
+        return self._each_file(['--symmetric'], paths)
+
+    def decrypt_files(self, paths):
+        return self._many_files(['--decrypt-files'], paths,
+                                decrypted_file_name)
+
+    def _each_file(self, args, paths):
+        failed = []
+        for path in paths:
+            try:
+                self._run(args + [path])
+            except GPGError as err:
+                failed.append((path, error_text(err)))
+        return failed
+
+    def _many_files(self, args, paths, output_name):
+        ''' Process all `paths` in one gpg run; on error find failed files
+        by missing or not changed output (gpg does not overwrite existing
+        files in batch mode) '''
+        paths = list(paths)
+        outputs = dict((path, output_name(path)) for path in paths)
+        before = dict((path, _file_stamp(output))
+                      for path, output in outputs.items())
+        try:
+            self._run(args + paths)
+        except GPGError as err:
+            lines = error_text(err).splitlines()
+            failed = []
+            for path in paths:
+                stamp = _file_stamp(outputs[path])
+                if stamp is not None and stamp != before[path]:
+                    continue
+                message = [line for line in lines if path in line]
+                failed.append((path, '\n'.join(message or lines)))
+            return failed
+        return []
+
+
+class _GPGMEBackend(object):
+    ''' Run operations in-process with GPGME; new context is created for
+    each operation because contexts can not be shared between threads. '''
+    name = 'gpgme'
+    multiple_files = ()
+
+    def _context(self, armor=True):
+        return gpg.Context(armor=armor)
+
+    def _keys(self, ctx, patterns, secret=False):
+        keys = []
+        for pattern in patterns:
+            found = list(ctx.keylist(pattern, secret=secret))
+            if not found:
+                raise GPGError(_("Key %s not found") % pattern)
+            keys.append(found[0])
+        return keys
+
+    def _call(self, func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except gpg.errors.GpgError as err:
+            raise GPGError(error_text(err))
+
+    def sign(self, data, key=None):
+        with self._context() as ctx:
+            if key:
+                ctx.signers = self._keys(ctx, (key, ), True)
+            return self._call(ctx.sign, to_bytes(data),
+                              mode=gpg.constants.sig.mode.CLEAR)[0]
+
+    def encrypt(self, data, recipients, sign=False):
+        with self._context() as ctx:
+            keys = self._keys(ctx, recipients)
+            return self._call(ctx.encrypt, to_bytes(data), recipients=keys,
+                              sign=sign)[0]
+
+    def encrypt_symmetric(self, data):
+        with self._context() as ctx:
+            return self._call(ctx.encrypt, to_bytes(data), recipients=None,
+                              sign=False)[0]
+
+    def decrypt(self, data):
+        with self._context() as ctx:
+            return self._call(ctx.decrypt, to_bytes(data), verify=False)[0]
+
+    def verify(self, data):
+        with self._context() as ctx:
+            return self._verify(ctx, to_bytes(data))
+
+    def verify_file(self, path, datafile=None):
+        with self._context() as ctx:
+            datafile = datafile or detached_data_file(path)
+            try:
+                with open(path, 'rb') as sigfile:
+                    if datafile:
+                        with open(datafile, 'rb') as dfile:
+                            return self._verify(ctx, dfile, sigfile)
+                    return self._verify(ctx, sigfile)
+            except IOError as err:
+                return (_signature(SIG_ERROR, message=error_text(err)), )
+
+    def _verify(self, ctx, data, signature=None):
+        try:
+            _data, result = ctx.verify(data, signature=signature)
+        except gpg.errors.BadSignatures as err:
+            result = err.result
+        except gpg.errors.GpgError as err:
+            return (_signature(SIG_ERROR, message=error_text(err)), )
+        if not result.signatures:
+            return (_signature(SIG_ERROR, message=_("No signature found")), )
+        return tuple(self._signature(ctx, sig) for sig in result.signatures)
+
+    def _signature(self, ctx, sig):
+        sigsum = gpg.constants.sigsum
+        if sig.summary & sigsum.KEY_MISSING:
+            status = SIG_NO_KEY
+        elif sig.summary & sigsum.KEY_REVOKED:
+            status = SIG_REVOKED_KEY
+        elif sig.summary & sigsum.KEY_EXPIRED:
+            status = SIG_EXPIRED_KEY
+        elif sig.summary & sigsum.SIG_EXPIRED:
+            status = SIG_EXPIRED
+        elif sig.summary & sigsum.RED:
+            status = SIG_BAD
+        elif sig.status == 0:
+            status = SIG_GOOD
+        else:
+            status = SIG_ERROR
+        uid = None
+        if status != SIG_NO_KEY:
+            try:
+                key = ctx.get_key(sig.fpr)
+                uid = key.uids[0].uid if key.uids else None
+            except gpg.errors.GpgError:
+                pass
+        return _signature(status, sig.fpr[-16:], sig.fpr, uid,
+                          sig.timestamp or None,
+                          _GPGME_VALIDITY.get(sig.validity),
+                          None if status != SIG_ERROR else
+                          gpg.errors.GPGMEError(sig.status).getstring())
+
+    def export_key(self, keyid):
+        with self._context() as ctx:
+            key = self._call(ctx.key_export, keyid)
+        if not key:
+            raise GPGError(_("Key %s not found") % keyid)
+        return key
+
+    def import_key(self, data):
+        with self._context() as ctx:
+            result = self._call(ctx.key_import, to_bytes(data))
+        if not result or isinstance(result, str):
+            raise GPGError(result or _("No keys imported"))
+        return _("Keys processed: %(total)d, imported: %(imported)d, "
+                 "unchanged: %(unchanged)d") % {
+                     'total': result.considered,
+                     'imported': result.imported,
+                     'unchanged': result.unchanged}
+
+    def sign_files(self, paths, key=None):
+        def sign(ctx, infile, outfile):
+            if key:
+                ctx.signers = self._keys(ctx, (key, ), True)
+            ctx.sign(infile, sink=outfile,
+                     mode=gpg.constants.sig.mode.DETACH)
+        return self._each_file(paths, lambda path: path + '.sig', sign)
+
+    def encrypt_files(self, paths, recipients, sign=False):
+        def encrypt(ctx, infile, outfile):
+            ctx.encrypt(infile, recipients=self._keys(ctx, recipients),
+                        sign=sign, sink=outfile)
+        return self._each_file(paths, lambda path: path + '.gpg', encrypt)
+
+    def encrypt_files_symmetric(self, paths):
+        def encrypt(ctx, infile, outfile):
+            ctx.encrypt(infile, recipients=None, sign=False, sink=outfile)
+        return self._each_file(paths, lambda path: path + '.gpg', encrypt)
+
+    def decrypt_files(self, paths):
+        def decrypt(ctx, infile, outfile):
+            ctx.decrypt(infile, sink=outfile, verify=False)
+        return self._each_file(paths, decrypted_file_name, decrypt)
+
+    def _each_file(self, paths, output_name, func):
+        ''' Call func(ctx, infile, outfile) for each path; output file is
+        created only when operation succeeded. Existing files are not
+        overwritten, like gpg in batch mode does. '''
+        failed = []
+        for path in paths:
+            output = output_name(path)
+            if not output:
+                failed.append((path, _("Unknown output file name")))
+                continue
+            if os.path.exists(output):
+                failed.append((path, _("File %s exists") % output))
+                continue
+            tmpname = '%s.%d-%d.tmp' % (output, os.getpid(),
+                                        threading.current_thread().ident)
+            try:
+                with self._context(armor=False) as ctx:
+                    with open(path, 'rb') as infile:
+                        with open(tmpname, 'wb') as outfile:
+                            func(ctx, infile, outfile)
+                os.rename(tmpname, output)
+            except (gpg.errors.GpgError, GPGError, IOError, OSError) as err:
+                failed.append((path, error_text(err)))
+                if os.path.exists(tmpname):
+                    os.unlink(tmpname)
+        return failed
+
+
+if gpg is not None:
+    _GPGME_VALIDITY = {
+        gpg.constants.validity.UNDEFINED: 'undefined',
+        gpg.constants.validity.NEVER: 'never',
+        gpg.constants.validity.MARGINAL: 'marginal',
+        gpg.constants.validity.FULL: 'fully',
+        gpg.constants.validity.ULTIMATE: 'ultimate',
+    }
+
+
+def _recipients_params(recipients):
+    for recipient in recipients:
+        yield '-r'
+        yield recipient
+
+
+_BACKEND = None
+_BACKEND_LOCK = threading.Lock()
+
+
+def get_backend():
+    ''' Get shared backend instance '''
+    global _BACKEND
+    with _BACKEND_LOCK:
+        if _BACKEND is None:
+            if gpg is not None and USE_GPGME:
+                _BACKEND = _GPGMEBackend()
+            else:
+                _BACKEND = _SubprocessBackend()
+        return _BACKEND
@@ -1,21 +1,29 @@
 # -*- coding: UTF-8 -*-
 __kupfer_name__ = _("GnuPG File")
 __kupfer_actions__ = ("SignFile", "EncryptFile", "SignEncryptFile",
-                      "VerifyFile", "DecryptFile", "EncryptFileSymmetric")
+                      "VerifyFile", "VerifyChecksums", "DecryptFile",
+                      "EncryptFileSymmetric")
 __description__ = _("Encrypt, decrypt, sign and verify files with GnuPG")
 __version__ = "2010-05-30"
 __author__ = "Karol Będkowski <karol.bedkowski@gmail.com>"
 
+import io
 import os
-import subprocess
+import re
+import time
+from multiprocessing.pool import ThreadPool
 
+import gobject
+
+from kupfer import pretty
 from kupfer import uiutils
-from kupfer import utils
 from kupfer import plugin_support
+from kupfer import task
 from kupfer.obj.base import Action
 from kupfer.obj.objects import FileLeaf, TextLeaf
 
 import gnupg_support as support
+import gnupg_backend as backend
 
 __kupfer_settings__ = plugin_support.PluginSettings({
     "key": "ask_for_key",
@@ -30,6 +38,102 @@ __kupfer_settings__ = plugin_support.PluginSettings({
     "tooltip": _("Leave this field blank for use default GnuPG key.")
 })
 
+# max number of files passed to one gpg --encrypt-files/--decrypt-files
+BATCH_CHUNK_SIZE = 32
+# min time between progress notifications (sec)
+BATCH_PROGRESS_INTERVAL = 2
+# max number of failed files listed in summary
+BATCH_MAX_REPORTED = 10
+# checksum manifests names (SHA256SUMS, sha1sums.txt.asc, ...)
+_RE_CHECKSUMS_FILE = re.compile(
+    r'^(sha(1|224|256|384|512)|md5)sums?(\.txt)?(\.(asc|sig|gpg))?$', re.I)
+
+
+class _BatchTask(task.ThreadTask):
+    ''' Run backend file `operation` on `paths` on pool of workers.
+
+    When `multiple` is True operation is called with chunks of files
+    (gpg --encrypt-files, --decrypt-files), otherwise with one file per
+    call. Progress of long batches is shown in notification; summary
+    with failed files is shown at the end. '''
+
+    def __init__(self, title, operation, paths, args=(), multiple=False):
+        task.ThreadTask.__init__(self)
+        self.title = title
+        self.operation = operation
+        self.paths = list(paths)
+        self.args = args
+        self.multiple = multiple
+        self.failed = []
+        self._nid = None
+
+    def _jobs(self, workers):
+        if not self.multiple:
+            return [[path] for path in self.paths]
+        # spread files over all workers but keep gpg command lines short
+        size = max(1, min(BATCH_CHUNK_SIZE,
+                          -(-len(self.paths) // workers)))
+        return [self.paths[start:start + size]
+                for start in range(0, len(self.paths), size)]
+
+    def _run_job(self, paths):
+        try:
+            return len(paths), self.operation(paths, *self.args)
+        except Exception as err:
+            pretty.print_error(__name__, self.title, 'failed:', err)
+            message = backend.error_text(err)
+            return len(paths), [(path, message) for path in paths]
+
+    def thread_do(self):
+        workers = support.worker_count()
+        jobs = self._jobs(workers)
+        if len(jobs) == 1:
+            self.failed = self._run_job(jobs[0])[1]
+            return
+        pool = ThreadPool(min(workers, len(jobs)))
+        done = 0
+        last_progress = time.time()
+        try:
+            for count, failed in pool.imap_unordered(self._run_job, jobs):
+                done += count
+                self.failed.extend(failed)
+                if time.time() - last_progress >= BATCH_PROGRESS_INTERVAL:
+                    last_progress = time.time()
+                    # notifications are shown from main loop
+                    gobject.idle_add(
+                        self._notify,
+                        _("%(done)d of %(total)d files processed")
+                        % {'done': done, 'total': len(self.paths)})
+        finally:
+            pool.close()
+            pool.join()
+
+    def thread_finish(self):
+        total = len(self.paths)
+        if not self.failed:
+            if total > 1:
+                self._notify(_("%d files processed") % total)
+            return
+        failed = sorted(self.failed)
+        lines = ["%s: %s" % (os.path.basename(path), message)
+                 for path, message in failed[:BATCH_MAX_REPORTED]]
+        if len(failed) > BATCH_MAX_REPORTED:
+            lines.append(_("and %d more") %
+                         (len(failed) - BATCH_MAX_REPORTED))
+        self._notify(_("%(failed)d of %(total)d files failed")
+                     % {'failed': len(failed), 'total': total}
+                     + "\n" + "\n".join(lines))
+
+    def _notify(self, body):
+        ''' Show or update notification; must be called in main loop '''
+        self._nid = uiutils.show_notification(self.title, body,
+                                              nid=self._nid)
+        return False
+
+
+def _multiple_files(operation):
+    return operation in backend.get_backend().multiple_files
+
 
 class SignFile(Action):
     def __init__(self):
@@ -37,14 +141,19 @@ class SignFile(Action):
           else _("Sign")
         Action.__init__(self, name)
 
+    def is_async(self):
+        return True
+
     def activate(self, leaf, iobj=None):
-        key = iobj.object if iobj else __kupfer_settings__['default_key']
-        cli = ['gpg', '--detach-sign', '--batch']
-        if key:
-            cli.append('--local-user')
-            cli.append(key)
-        cli.append(leaf.object)
-        utils.spawn_async(cli)
+        return self.activate_multiple((leaf, ), (iobj, ) if iobj else None)
+
+    def activate_multiple(self, objects, iobjects=None):
+        if iobjects:
+            key = list(iobjects)[0].object
+        else:
+            key = __kupfer_settings__['default_key']
+        return _BatchTask(_("Sign"), backend.get_backend().sign_files,
+                          (obj.object for obj in objects), (key, ))
 
     def item_types(self):
         yield FileLeaf
@@ -71,15 +180,17 @@ class EncryptFile(Action):
     def __init__(self):
         Action.__init__(self, _("Encrypt For..."))
 
+    def is_async(self):
+        return True
+
     def activate(self, leaf, iobj):
-        self.activate_multiple((leaf, ), (iobj, ))
+        return self.activate_multiple((leaf, ), (iobj, ))
 
     def activate_multiple(self, objects, iobjects):
-        recipients = (iobj.object for iobj in iobjects)
-        cli = ['gpg', '--encrypt-files', '--batch']
-        cli.extend(support.format_recipients_params(recipients))
-        cli.extend(obj.object for obj in objects)
-        utils.spawn_async(cli)
+        recipients = [iobj.object for iobj in iobjects]
+        return _BatchTask(_("Encrypt"), backend.get_backend().encrypt_files,
+                          (obj.object for obj in objects), (recipients, ),
+                          _multiple_files('encrypt'))
 
     def item_types(self):
         yield FileLeaf
@@ -104,17 +215,17 @@ class SignEncryptFile(Action):
     def __init__(self):
         Action.__init__(self, _("Sign and Encrypt For..."))
 
+    def is_async(self):
+        return True
+
     def activate(self, leaf, iobj):
-        self.activate_multiple((leaf, ), (iobj, ))
+        return self.activate_multiple((leaf, ), (iobj, ))
 
     def activate_multiple(self, objects, iobjects):
-        recipients = (iobj.object for iobj in iobjects)
-        cli = ['gpg', '--sign', '--encrypt', '--batch']
-        cli.extend(support.format_recipients_params(recipients))
-        for obj in objects:
-            cli_ = cli[:]
-            cli_.append(obj.object)
-            utils.spawn_async(cli_)
+        recipients = [iobj.object for iobj in iobjects]
+        return _BatchTask(_("Sign and Encrypt"),
+                          backend.get_backend().encrypt_files,
+                          (obj.object for obj in objects), (recipients, True))
 
     def item_types(self):
         yield FileLeaf
@@ -140,13 +251,16 @@ class VerifyFile(Action):
     def __init__(self):
         Action.__init__(self, _("Verify Signature"))
 
+    def is_async(self):
+        return True
+
     def activate(self, leaf):
-        cli = ["gpg", "--verify", "--batch", leaf.object]
-        p = subprocess.Popen(
-            cli, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate()
-        uiutils.show_text_result(
-            stdout or stderr, title=_("Verification Result"))
+        return self.activate_multiple((leaf, ))
+
+    def activate_multiple(self, objects):
+        return support.VerifyTask(
+            support.VERIFY_CACHE.verify_file,
+            ((os.path.basename(obj.object), obj.object) for obj in objects))
 
     def item_types(self):
         yield FileLeaf
@@ -159,17 +273,161 @@ class VerifyFile(Action):
         return _("Verify signature validity for selected file")
 
 
+class _ChecksumsTask(task.ThreadTask):
+    ''' Verify signature of checksums manifest then check all listed files
+    on pool of workers '''
+
+    def __init__(self, path):
+        task.ThreadTask.__init__(self)
+        self.path = path
+        self.signature = None
+        self.signatures = None
+        self.results = None
+        self.error = None
+
+    def thread_do(self):
+        manifest, self.signature = _checksums_files(self.path)
+        if not self.signature:
+            self.error = _("Signature of %s not found") % \
+                os.path.basename(manifest)
+            return
+        # manifest is given explicitly; detached signature may have any
+        # extension (i.e. SHA256SUMS.gpg)
+        self.signatures = support.VERIFY_CACHE.verify_file(
+            self.signature, manifest if manifest != self.signature else None)
+        support.VERIFY_CACHE.save()
+        if not all(sig.status == backend.SIG_GOOD
+                   for sig in self.signatures):
+            return
+        try:
+            with io.open(manifest, 'r', encoding='utf-8',
+                         errors='replace') as mfile:
+                lines = mfile.readlines()
+        except IOError as err:
+            self.error = backend.error_text(err)
+            return
+        if self.signature == manifest:
+            lines = support.clearsigned_text(lines)
+        basedir = os.path.dirname(manifest)
+        entries = [(os.path.join(basedir, name), name, algorithm, digest)
+                   for name, algorithm, digest
+                   in support.parse_checksums(lines)]
+        if not entries:
+            self.error = _("No checksums found in %s") % \
+                os.path.basename(manifest)
+            return
+        # hashing releases GIL; use at least a few workers so reading of
+        # files overlaps also on machines with few cores
+        pool = ThreadPool(min(len(entries), max(4, support.worker_count())))
+        try:
+            self.results = pool.map(_check_file, entries)
+        finally:
+            pool.close()
+            pool.join()
+
+    def thread_finish(self):
+        text = []
+        if self.signatures:
+            text.append(support.format_verify_results(
+                [(os.path.basename(self.signature), self.signatures)]))
+        if self.error:
+            text.append(self.error)
+        elif self.results is None:
+            text.append(_("Files were not checked because signature is not "
+                          "valid."))
+        else:
+            text.append(_format_checksums_results(self.results))
+        uiutils.show_text_result("\n\n".join(text),
+                                 title=_("Checksums Verification Result"))
+
+
+def _checksums_files(path):
+    ''' Find manifest and its signature file for `path` - manifest or
+    signature; signature is None when not found. '''
+    if path.endswith(('.asc', '.sig', '.gpg')):
+        return backend.detached_data_file(path) or path, path
+    if backend.is_clearsigned(path):
+        return path, path
+    for ext in ('.asc', '.sig', '.gpg'):
+        if os.path.isfile(path + ext):
+            return path, path + ext
+    return path, None
+
+
+def _check_file(entry):
+    ''' Check file checksum; return (name, status, error message) '''
+    path, name, algorithm, digest = entry
+    try:
+        if support.hash_file(path, algorithm) == digest:
+            return name, 'ok', None
+        return name, 'mismatch', None
+    except (IOError, OSError) as err:
+        if not os.path.exists(path):
+            return name, 'missing', None
+        return name, 'error', backend.error_text(err)
+
+
+def _format_checksums_results(results):
+    counts = {}
+    failed = {}
+    for name, status, message in results:
+        counts[status] = counts.get(status, 0) + 1
+        if status != 'ok':
+            failed.setdefault(status, []).append(
+                "    %s: %s" % (name, message) if message else "    " + name)
+    lines = [_("Files: %(total)d, OK: %(ok)d, mismatched: %(mismatch)d, "
+               "missing: %(missing)d, errors: %(error)d") % {
+                   'total': len(results),
+                   'ok': counts.get('ok', 0),
+                   'mismatch': counts.get('mismatch', 0),
+                   'missing': counts.get('missing', 0),
+                   'error': counts.get('error', 0)}]
+    for status, title in (('mismatch', _("Checksum mismatch:")),
+                          ('missing', _("Missing files:")),
+                          ('error', _("Read errors:"))):
+        if status in failed:
+            lines.append("")
+            lines.append(title)
+            lines.extend(sorted(failed[status]))
+    return "\n".join(lines)
+
+
+class VerifyChecksums(Action):
+    def __init__(self):
+        Action.__init__(self, _("Verify Checksums"))
+
+    def is_async(self):
+        return True
+
+    def activate(self, leaf):
+        return _ChecksumsTask(leaf.object)
+
+    def item_types(self):
+        yield FileLeaf
+
+    def valid_for_item(self, leaf):
+        return os.path.isfile(leaf.object) and \
+            bool(_RE_CHECKSUMS_FILE.match(os.path.basename(leaf.object)))
+
+    def get_description(self):
+        return _("Verify signature of checksums file and checksums of "
+                 "listed files")
+
+
 class DecryptFile(Action):
     def __init__(self):
         Action.__init__(self, _("Decrypt"))
 
+    def is_async(self):
+        return True
+
     def activate(self, leaf):
-        self.activate_multiple((leaf, ))
+        return self.activate_multiple((leaf, ))
 
     def activate_multiple(self, objects):
-        cli = ['gpg', '--decrypt-files', '--batch']
-        cli.extend(obj.object for obj in objects)
-        utils.spawn_async(cli)
+        return _BatchTask(_("Decrypt"), backend.get_backend().decrypt_files,
+                          (obj.object for obj in objects), (),
+                          _multiple_files('decrypt'))
 
     def item_types(self):
         yield FileLeaf
@@ -186,9 +444,16 @@ class EncryptFileSymmetric(Action):
     def __init__(self):
         Action.__init__(self, _("Encrypt With Symmetric Cipher"))
 
+    def is_async(self):
+        return True
+
     def activate(self, leaf):
-        cli = ['gpg', '--symmetric', '--batch', leaf.object]
-        utils.spawn_async(cli)
+        return self.activate_multiple((leaf, ))
+
+    def activate_multiple(self, objects):
+        return _BatchTask(_("Encrypt"),
+                          backend.get_backend().encrypt_files_symmetric,
+                          (obj.object for obj in objects))
 
     def item_types(self):
         yield FileLeaf
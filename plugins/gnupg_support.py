@@ -5,21 +5,51 @@ from __future__ import with_statement
 __version__ = "2010-05-28"
 __author__ = "Karol Będkowski <karol.bedkowski@gmail.com>"
 
+import hashlib
+import io
+import json
+import multiprocessing
 import os
+import re
 import subprocess
+import tempfile
+import threading
 import time
-
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+try:
+    from sys import intern
+except ImportError:
+    pass
+
+from kupfer import config
+from kupfer import pretty
+from kupfer import task
+from kupfer import uiutils
 from kupfer import utils
 from kupfer.obj.base import Leaf, Action, Source
 from kupfer.obj.objects import TextLeaf
 from kupfer.obj.helplib import FilesystemWatchMixin
 
+import gnupg_backend as backend
+
 KEYS_PRIVATE = '-K'
 KEYS_PUBLIC = '-k'
 PGP_HEADER_MSG = '-----BEGIN PGP MESSAGE-----'
 PGP_HEADER_SIG = '-----BEGIN PGP SIGNED MESSAGE----'
 PGP_HEADER_PUBKEY = '-----BEGIN PGP PUBLIC KEY BLOCK-----'
 
+GNUPG_HOME = os.path.expanduser(os.environ.get('GNUPGHOME', '~/.gnupg'))
+# keyring files; keys are loaded again when any of them change
+KEYRING_FILES = ('pubring.kbx', 'pubring.gpg', 'trustdb.gpg')
+SECRING_FILES = KEYRING_FILES + ('secring.gpg', 'private-keys-v1.d')
+# store loaded keys also in cache directory
+KEYS_DISK_CACHE = True
+# store results of files verification in cache directory
+VERIFY_DISK_CACHE = True
+# max number of remembered files verification results
+VERIFY_CACHE_SIZE = 1000
+
 TRUST_NAMES = {
     "n": _("don't trust"),
     "m": _("marginal"),
@@ -28,19 +58,35 @@ TRUST_NAMES = {
     "-": _("unknown"),
 }
 
+SIGNATURE_STATUS_NAMES = {
+    backend.SIG_GOOD: _("Good signature"),
+    backend.SIG_BAD: _("BAD signature"),
+    backend.SIG_EXPIRED: _("Expired signature"),
+    backend.SIG_EXPIRED_KEY: _("Good signature by expired key"),
+    backend.SIG_REVOKED_KEY: _("Good signature by revoked key"),
+    backend.SIG_NO_KEY: _("Unknown key"),
+    backend.SIG_ERROR: _("Verification error"),
+}
+
 
 class Key(Leaf):
-    def __init__(self, keyid, owner, trust, expiration):
-        Leaf.__init__(self, keyid, owner)
-        desc = [_("Id:"), keyid[-8:]] if keyid else []
-        if trust:
-            desc.extend((_("Trust:"), TRUST_NAMES.get(trust, trust)))
-        if expiration and expiration != '-':
-            desc.extend((_("Expire:"), expiration))
-        self._description = " ".join(desc)
+    ''' View of one uid of shared KeyRecord; `record` is None for default
+    key. '''
+    def __init__(self, record, owner):
+        Leaf.__init__(self, record.keyid if record else None, owner)
+        self.record = record
 
     def get_description(self):
-        return self._description
+        record = self.record
+        if record is None:
+            return ""
+        desc = [_("Id:"), record.keyid[-8:]]
+        if record.trust:
+            desc.extend((_("Trust:"),
+                         TRUST_NAMES.get(record.trust, record.trust)))
+        if record.expiration:
+            desc.extend((_("Expire:"), _format_date(record.expiration)))
+        return " ".join(desc)
 
     def get_actions(self):
         yield _GetPublicKey()
@@ -51,7 +97,7 @@ class Key(Leaf):
 
 
 class PublicKeysSource(Source, FilesystemWatchMixin):
-    _gnupg_home = os.path.expanduser("~/.gnupg/")
+    _gnupg_home = GNUPG_HOME
 
     def __init__(self):
         Source.__init__(self, _("GnuPG Public Keyring"))
@@ -60,11 +106,12 @@ class PublicKeysSource(Source, FilesystemWatchMixin):
         self._monitor_token = self.monitor_directories(self._gnupg_home)
 
     def monitor_include_file(self, gfile):
-        return gfile and gfile.get_basename().endswith('.gpg')
+        return gfile and gfile.get_basename() in KEYRING_FILES
 
     def get_items(self):
-        for key, owner, trust, expiration in _get_keys(KEYS_PUBLIC):
-            yield Key(key, owner, trust, expiration)
+        for key in KEYS_CACHE.get(KEYS_PUBLIC):
+            for owner in key.uids:
+                yield Key(key, owner)
 
     def should_sort_lexically(self):
         return True
@@ -75,9 +122,10 @@ class PrivateKeysSource(Source):
         Source.__init__(self, _("GnuPG Private Keyring"))
 
     def get_items(self):
-        yield Key(None, _("Default Private Key"), None, None)
-        for key, owner, trust, expiration in _get_keys(KEYS_PRIVATE):
-            yield Key(key, owner, trust, expiration)
+        yield Key(None, _("Default Private Key"))
+        for key in KEYS_CACHE.get(KEYS_PRIVATE):
+            for owner in key.uids:
+                yield Key(key, owner)
 
     def should_sort_lexically(self):
         return True
@@ -91,11 +139,13 @@ class _GetPublicKey(Action):
         return True
 
     def activate(self, leaf):
-        p = subprocess.Popen(
-            ["gpg", "--export", "--armor", leaf.object],
-            stdout=subprocess.PIPE)
-        stdout, _stderr = p.communicate()
-        return TextLeaf(stdout)
+        try:
+            key = backend.get_backend().export_key(leaf.object)
+        except backend.GPGError as err:
+            uiutils.show_notification(_("Export Public Key"),
+                                      backend.error_text(err))
+            return None
+        return TextLeaf(backend.to_text(key))
 
     def get_description(self):
         return _("Get ASCII armored public key")
@@ -113,42 +163,473 @@ class _EditKey(Action):
         return _("Open terminal and edit selected GnuPG key")
 
 
+class VerifyTask(task.ThreadTask):
+    ''' Verify `items` - list of (name, argument for `verify` function) -
+    on pool of workers; show one summary of all results. '''
+
+    def __init__(self, verify, items):
+        task.ThreadTask.__init__(self)
+        self.verify = verify
+        self.items = list(items)
+        self.results = None
+
+    def _verify(self, item):
+        name, arg = item
+        try:
+            return name, self.verify(arg)
+        except Exception as err:
+            pretty.print_error(__name__, 'verify', name, 'failed:', err)
+            return name, (backend.Signature(backend.SIG_ERROR, None, None,
+                                            None, None, None,
+                                            backend.error_text(err)), )
+
+    def thread_do(self):
+        if len(self.items) == 1:
+            self.results = [self._verify(self.items[0])]
+            VERIFY_CACHE.save()
+            return
+        pool = ThreadPool(min(worker_count(), len(self.items)))
+        try:
+            self.results = pool.map(self._verify, self.items)
+        finally:
+            pool.close()
+            pool.join()
+            VERIFY_CACHE.save()
+
+    def thread_finish(self):
+        uiutils.show_text_result(format_verify_results(self.results),
+                                 title=_("Verification Result"))
+
+
+def format_verify_results(results):
+    ''' Format list of (name, signatures) as text; summary first '''
+    counts = {}
+    lines = []
+    for name, signatures in results:
+        lines.append(name)
+        for sig in signatures:
+            counts[sig.status] = counts.get(sig.status, 0) + 1
+            lines.append("    " + _format_signature(sig))
+    summary = [_("Good: %d") % counts.get(backend.SIG_GOOD, 0),
+               _("Bad: %d") % counts.get(backend.SIG_BAD, 0),
+               _("Unknown key: %d") % counts.get(backend.SIG_NO_KEY, 0)]
+    others = sum(count for status, count in counts.items()
+                 if status not in (backend.SIG_GOOD, backend.SIG_BAD,
+                                   backend.SIG_NO_KEY))
+    if others:
+        summary.append(_("Other: %d") % others)
+    return "\n".join([", ".join(summary), ""] + lines)
+
+
+def _format_signature(sig):
+    text = [SIGNATURE_STATUS_NAMES.get(sig.status, sig.status)]
+    if sig.uid:
+        text.append(_("from \"%s\"") % sig.uid)
+    if sig.keyid:
+        text.append(sig.keyid[-16:] if sig.status == backend.SIG_NO_KEY
+                    else _("key %s") % sig.keyid[-16:])
+    if sig.trust:
+        text.append("[%s]" % sig.trust)
+    if sig.timestamp:
+        text.append(_("made %s") % time.strftime(
+            "%x %X", time.localtime(sig.timestamp)))
+    if sig.message:
+        text.append("- " + sig.message.replace("\n", " "))
+    return " ".join(text)
+
+
+def worker_count():
+    ''' Number of workers for parallel gpg operations '''
+    try:
+        return max(1, multiprocessing.cpu_count())
+    except NotImplementedError:
+        return 1
+
+
 #===============
 
+# version of keys cache file format
+KEYS_CACHE_VERSION = 2
+
+
+class KeyRecord(object):
+    ''' Immutable primary key record shared by all Key leaves of the key.
+
+    uids is tuple of user ids, uids_validity - string with validity flag
+    of each uid; subkeys is tuple of (keyid, fingerprint, capabilities);
+    expiration is unix timestamp or None. '''
+
+    __slots__ = ('keyid', 'fingerprint', 'trust', 'expiration',
+                 'capabilities', 'uids', 'uids_validity', 'subkeys')
+
+    def __init__(self, keyid, fingerprint, trust, expiration, capabilities,
+                 uids, uids_validity, subkeys):
+        setattr_ = object.__setattr__
+        setattr_(self, 'keyid', keyid)
+        setattr_(self, 'fingerprint', fingerprint)
+        # trust and capabilities have only a few distinct values
+        setattr_(self, 'trust', intern(str(trust)) if trust else trust)
+        setattr_(self, 'expiration', expiration)
+        setattr_(self, 'capabilities', intern(str(capabilities)))
+        setattr_(self, 'uids', tuple(uids))
+        setattr_(self, 'uids_validity', uids_validity)
+        setattr_(self, 'subkeys', tuple(map(tuple, subkeys)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("KeyRecord is immutable")
+
+    __delattr__ = __setattr__
+
+    def as_tuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return (isinstance(other, KeyRecord)
+                and self.as_tuple() == other.as_tuple())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.as_tuple())
+
+    def __reduce__(self):
+        return (KeyRecord, self.as_tuple())
+
+    def __repr__(self):
+        return '<KeyRecord %s %r>' % (self.keyid, self.uids)
+
+
+class _KeysCache(object):
+    ''' Cache of keys listings; listing is valid as long as keyring files
+    are not modified. '''
+
+    def __init__(self):
+        # kind -> (keyring stamp, keys)
+        self._cache = {}
+
+    def get(self, kind):
+        stamp = keyring_stamp(kind)
+        entry = self._cache.get(kind)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        keys = self._load(kind, stamp)
+        if keys is None:
+            return self._read(kind, stamp)
+        self._cache[kind] = (stamp, keys)
+        return keys
+
+    def _read(self, kind, stamp):
+        ''' Yield keys as they are read from gpg; store them when finished '''
+        keys = []
+        for key in _get_keys(kind):
+            keys.append(key)
+            yield key
+        self._cache[kind] = (stamp, keys)
+        self._save(kind, stamp, keys)
+
+    def _load(self, kind, stamp):
+        if not KEYS_DISK_CACHE:
+            return None
+        try:
+            with open(_keys_cache_file(kind), 'r') as cfile:
+                version, cached_stamp, keys = json.load(cfile)
+        except (IOError, OSError, ValueError, TypeError):
+            return None
+        if version != KEYS_CACHE_VERSION or cached_stamp != stamp:
+            return None
+        return [_key_from_json(key) for key in keys]
+
+    def _save(self, kind, stamp, keys):
+        if not KEYS_DISK_CACHE:
+            return
+        try:
+            _save_json(_keys_cache_file(kind),
+                       [KEYS_CACHE_VERSION, stamp,
+                        [key.as_tuple() for key in keys]])
+        except (IOError, OSError) as err:
+            pretty.print_error(__name__, 'saving keys cache error', err)
+
+
+KEYS_CACHE = _KeysCache()
+
+
+def keyring_stamp(kind=KEYS_PUBLIC):
+    ''' Get size and mtime of keyring files '''
+    stamp = []
+    for filename in (SECRING_FILES if kind == KEYS_PRIVATE
+                     else KEYRING_FILES):
+        try:
+            fstat = os.stat(os.path.join(GNUPG_HOME, filename))
+            stamp.append([filename, fstat.st_size, fstat.st_mtime])
+        except OSError:
+            pass
+    return stamp
+
+
+def _keys_cache_file(kind):
+    name = 'private' if kind == KEYS_PRIVATE else 'public'
+    return os.path.join(config.get_cache_home(), 'gnupg_%s_keys.json' % name)
+
+
+# version of verification cache file format
+VERIFY_CACHE_VERSION = 1
+# signature files up to this size are identified by content hash
+_VERIFY_HASH_LIMIT = 1024 * 1024
+
+
+class _VerifyCache(object):
+    ''' Persistent cache of files verification results.
+
+    Result is valid as long as identity of data file (inode, size,
+    mtime_ns), hash of signature file and public keyring stamp are not
+    changed. Verification errors are not cached. '''
+
+    def __init__(self):
+        # path -> (identity, signatures); oldest first
+        self._cache = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def verify_file(self, path, datafile=None):
+        ''' Verify file with backend or get remembered result; `datafile`
+        is data signed by detached signature `path` when known. '''
+        identity = _verify_identity(path, datafile)
+        if identity is None:
+            return backend.get_backend().verify_file(path, datafile)
+        with self._lock:
+            cache = self._get_cache()
+            entry = cache.get(path)
+            if entry is not None and entry[0] == identity:
+                # move to end
+                cache[path] = cache.pop(path)
+                return entry[1]
+        result = backend.get_backend().verify_file(path, datafile)
+        if any(sig.status == backend.SIG_ERROR for sig in result) or \
+                _verify_identity(path, datafile) != identity:
+            # error or file changed during verification
+            return result
+        with self._lock:
+            cache.pop(path, None)
+            cache[path] = (identity, result)
+            while len(cache) > VERIFY_CACHE_SIZE:
+                cache.popitem(last=False)
+            self._dirty = True
+        return result
+
+    def _get_cache(self):
+        if self._cache is None:
+            self._cache = OrderedDict(self._load())
+        return self._cache
+
+    def _load(self):
+        if not VERIFY_DISK_CACHE:
+            return []
+        try:
+            with open(_verify_cache_file(), 'r') as cfile:
+                version, entries = json.load(cfile)
+            if version != VERIFY_CACHE_VERSION:
+                return []
+            return [(path, (identity, tuple(backend.Signature(*sig)
+                                            for sig in signatures)))
+                    for path, identity, signatures in entries]
+        except (IOError, OSError, ValueError, TypeError) as err:
+            pretty.print_debug(__name__, 'loading verify cache error', err)
+            return []
+
+    def save(self):
+        with self._lock:
+            if not self._dirty or not VERIFY_DISK_CACHE:
+                return
+            self._dirty = False
+            entries = [(path, identity, signatures)
+                       for path, (identity, signatures)
+                       in self._cache.items()]
+        try:
+            _save_json(_verify_cache_file(), [VERIFY_CACHE_VERSION, entries])
+        except (IOError, OSError) as err:
+            pretty.print_error(__name__, 'saving verify cache error', err)
+
+
+VERIFY_CACHE = _VerifyCache()
+
+
+def _verify_identity(path, datafile=None):
+    ''' Get identity of signature `path` and signed data as JSON-compatible
+    list or None when files are not accessible. '''
+    datafile = datafile or backend.detached_data_file(path) or path
+    try:
+        dstat = os.stat(datafile)
+        sstat = os.stat(path)
+        if datafile != path and sstat.st_size <= _VERIFY_HASH_LIMIT:
+            with open(path, 'rb') as sigfile:
+                sighash = hashlib.sha256(sigfile.read()).hexdigest()
+        else:
+            # inline signed file - data identity is enough
+            sighash = [sstat.st_size, _mtime_ns(sstat)]
+    except (IOError, OSError):
+        return None
+    return [dstat.st_dev, dstat.st_ino, dstat.st_size, _mtime_ns(dstat),
+            sighash, keyring_stamp(KEYS_PUBLIC)]
+
+
+def _mtime_ns(fstat):
+    try:
+        return fstat.st_mtime_ns
+    except AttributeError:
+        return int(fstat.st_mtime * 1e9)
+
+
+def _verify_cache_file():
+    return os.path.join(config.get_cache_home(), 'gnupg_verify_cache.json')
+
+
+def _save_json(path, data):
+    ''' Write `data` to temporary file and rename it to `path`, so
+    concurrent readers never see partially written file. '''
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path),
+                                   suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as cfile:
+            json.dump(data, cfile)
+        os.rename(tmpname, path)
+    except Exception:
+        os.remove(tmpname)
+        raise
+
+
+def _key_from_json(key):
+    return KeyRecord(*key)
+
 
 def _get_keys(kind=KEYS_PUBLIC):
-    p = subprocess.Popen(
+    ''' Yield KeyRecord for each valid key from gpg keys listing '''
+    # buffered pipe; Python 2 default (unbuffered) reads byte by byte
+    proc = subprocess.Popen(
         ["gpg", kind, "--fixed-list-mode", "--with-colons"],
-        stdout=subprocess.PIPE)
-    stdout, _stderr = p.communicate()
-    curr_key = None
-    for line in stdout.split('\n'):
-        sline = line.split(':')
-        rectype = sline[0]
+        stdout=subprocess.PIPE, bufsize=-1)
+    try:
+        for key in parse_keys_listing(iter(proc.stdout.readline, b'')):
+            yield key
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+def parse_keys_listing(lines):
+    ''' Parse gpg --with-colons keys listing; yield KeyRecord when each
+    key block is complete. Invalid, revoked, expired and disabled keys are
+    skipped. '''
+    key = None
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        fields = line.rstrip('\r\n').split(':')
+        rectype = fields[0]
         if rectype in ('pub', 'sec'):
-            trust = sline[1]
-            capabilities = sline[11]
-            curr_key = None
-            if trust in ('i', 'r', 'e') or capabilities == 'D':
+            if key:
+                yield _create_key(key)
+            key = None
+            trust = fields[1]
+            capabilities = fields[11] if len(fields) > 11 else ''
+            if trust in ('i', 'r', 'e') or 'D' in capabilities:
                 # skip invalid, revoked, expired and disabled keys
                 continue
-            keyid = sline[4]
-            expiration = _format_date(sline[6])
-            curr_key = (keyid, trust, expiration)
+            key = {'keyid': fields[4], 'fingerprint': None, 'trust': trust,
+                   'expiration': int(fields[6]) if fields[6] else None,
+                   'capabilities': capabilities, 'uids': [],
+                   'uids_validity': [], 'subkeys': []}
+        elif key is None:
+            continue
+        elif rectype == 'fpr':
+            if key['subkeys']:
+                keyid, _fpr, capabilities = key['subkeys'][-1]
+                key['subkeys'][-1] = (keyid, fields[9], capabilities)
+            elif not key['fingerprint']:
+                key['fingerprint'] = fields[9]
         elif rectype == 'uid':
-            if curr_key is None:
-                continue
-            owner = line.split(':')[9]
-            yield curr_key[0], owner, curr_key[1], curr_key[2]
+            key['uids'].append(_unescape(fields[9]))
+            key['uids_validity'].append(fields[1][:1] or '-')
+        elif rectype in ('sub', 'ssb'):
+            key['subkeys'].append((fields[4], None, fields[11]))
+    if key:
+        yield _create_key(key)
 
 
-def _format_date(timestamp):
-    if not timestamp:
-        return '-'
-    return time.strftime("%x", time.localtime(int(timestamp)))
+def _create_key(key):
+    key['uids_validity'] = ''.join(key['uids_validity'])
+    return KeyRecord(**key)
+
+
+_RE_ESCAPED = re.compile(r'\\x([0-9a-fA-F]{2})')
 
 
-def format_recipients_params(recipients):
-    for recipient in recipients:
-        yield '-r'
-        yield recipient
+def _unescape(value):
+    ''' Decode \\xNN escapes in colon listing field '''
+    return _RE_ESCAPED.sub(lambda match: chr(int(match.group(1), 16)), value)
+
+
+def _format_date(timestamp):
+    return time.strftime("%x", time.localtime(timestamp))
+
+
+# checksum algorithm by digest length (in hex digits)
+CHECKSUM_ALGORITHMS = {32: 'md5', 40: 'sha1', 56: 'sha224', 64: 'sha256',
+                       96: 'sha384', 128: 'sha512'}
+# size of buffer used for files hashing
+HASH_BUFFER_SIZE = 1024 * 1024
+
+_RE_BSD_CHECKSUM = re.compile(r'^\w+ \((.*)\) = ([0-9a-fA-F]+)$')
+_RE_GNU_CHECKSUM = re.compile(r'^\\?([0-9a-fA-F]+) [ *](.*)$')
+
+
+def clearsigned_text(lines):
+    ''' Yield lines of message from clearsigned text '''
+    lines = iter(lines)
+    for line in lines:
+        if line.startswith(PGP_HEADER_SIG):
+            break
+    # skip armor headers
+    for line in lines:
+        if not line.strip():
+            break
+    for line in lines:
+        if line.startswith('-----BEGIN PGP SIGNATURE'):
+            break
+        yield line[2:] if line.startswith('- ') else line
+
+
+def parse_checksums(lines):
+    ''' Parse sha256sum (GNU or BSD style) output; yield (file name,
+    hash algorithm, hex digest) '''
+    for line in lines:
+        line = line.rstrip('\r\n')
+        match = _RE_GNU_CHECKSUM.match(line) or _RE_BSD_CHECKSUM.match(line)
+        if not match:
+            continue
+        if match.re is _RE_GNU_CHECKSUM:
+            digest, name = match.groups()
+            if line.startswith('\\'):
+                name = name.replace('\\\\', '\0').replace('\\n', '\n') \
+                    .replace('\0', '\\')
+        else:
+            name, digest = match.groups()
+        algorithm = CHECKSUM_ALGORITHMS.get(len(digest))
+        if algorithm:
+            yield name, algorithm, digest.lower()
+
+
+def hash_file(path, algorithm):
+    ''' Calculate hex digest of file; read file in large blocks so hashing
+    (which releases GIL) runs in parallel with other threads '''
+    digest = hashlib.new(algorithm)
+    buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    with io.open(path, 'rb', buffering=0) as infile:
+        while True:
+            size = infile.readinto(buf)
+            if not size:
+                break
+            digest.update(view[:size])
+    return digest.hexdigest()
+
@@ -6,9 +6,6 @@ __description__ = _("Encrypt, decrypt, sign and verify text with GnuPG")
 __version__ = "2010-05-29"
 __author__ = "Karol Będkowski <karol.bedkowski@gmail.com>"
 
-import subprocess
-
-from kupfer import uiutils
 from kupfer import plugin_support
 from kupfer import commandexec
 from kupfer import task
@@ -16,6 +13,7 @@ from kupfer.obj.base import Action
 from kupfer.obj.objects import TextLeaf
 
 import gnupg_support as support
+import gnupg_backend as backend
 
 __kupfer_settings__ = plugin_support.PluginSettings({
     "key": "ask_for_key",
@@ -32,34 +30,29 @@ __kupfer_settings__ = plugin_support.PluginSettings({
 
 
 class _GPGTask(task.ThreadTask):
-    def __init__(self, cli, stdin, finish_callback):
+    ''' Call backend `operation` with `args`; pass result text or error
+    message to `finish_callback` '''
+    def __init__(self, operation, args, finish_callback):
         task.ThreadTask.__init__(self)
-        self.cli = cli
+        self.operation = operation
+        self.args = args
         self.finish_callback = finish_callback
-        self.stdin = stdin
-        self.resutl = None
+        self.result = None
 
     def thread_do(self):
         try:
-            p = subprocess.Popen(
-                self.cli,
-                stdout=subprocess.PIPE,
-                stdin=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-            stdout, stderr = p.communicate(self.stdin)
-        except OSError as err:
-            stderr = _("Error when running GPG: %s") % str(err)
-            stdout = None
-        self.result = stdout or stderr
+            self.result = backend.to_text(self.operation(*self.args))
+        except backend.GPGError as err:
+            self.result = backend.error_text(err)
 
     def thread_finish(self):
         self.finish_callback(self.result)
 
 
-def _create_gpg_task(cli, stdin, finish_callback):
+def _create_gpg_task(operation, args, finish_callback):
     ctx = commandexec.DefaultActionExecutionContext()
     async_token = ctx.get_async_token()
-    return async_token, _GPGTask(cli, stdin, finish_callback)
+    return async_token, _GPGTask(operation, args, finish_callback)
 
 
 class SignText(Action):
@@ -73,11 +66,9 @@ class SignText(Action):
 
     def activate(self, leaf, iobj=None):
         key = iobj.object if iobj else __kupfer_settings__['default_key']
-        cli = ["gpg", "--clearsign", "--batch"]
-        if key:
-            cli.extend(("--local-user", key))
-        self.async_token, task = _create_gpg_task(cli, leaf.object,
-                                                  self._finish_callback)
+        self.async_token, task = _create_gpg_task(
+            backend.get_backend().sign, (leaf.object, key),
+            self._finish_callback)
         return task
 
     def item_types(self):
@@ -114,11 +105,10 @@ class EncryptText(Action):
 
     def activate_multiple(self, objects, iobjects):
         text = list(objects)[0].object
-        recipients = (iobj.object for iobj in iobjects)
-        cli = ["gpg", "--encrypt", "--armor", "--batch"]
-        cli.extend(support.format_recipients_params(recipients))
-        self.async_token, task = _create_gpg_task(cli, text,
-                                                  self._finish_callback)
+        recipients = [iobj.object for iobj in iobjects]
+        self.async_token, task = _create_gpg_task(
+            backend.get_backend().encrypt, (text, recipients, False),
+            self._finish_callback)
         return task
 
     def item_types(self):
@@ -153,11 +143,10 @@ class SignEncryptText(Action):
 
     def activate_multiple(self, objects, iobjects):
         text = list(objects)[0].object
-        recipients = (iobj.object for iobj in iobjects)
-        cli = ["gpg", "--sign", "--encrypt", "--armor", "--batch"]
-        cli.extend(support.format_recipients_params(recipients))
-        self.async_token, task = _create_gpg_task(cli, text,
-                                                  self._finish_callback)
+        recipients = [iobj.object for iobj in iobjects]
+        self.async_token, task = _create_gpg_task(
+            backend.get_backend().encrypt, (text, recipients, True),
+            self._finish_callback)
         return task
 
     def item_types(self):
@@ -185,16 +174,17 @@ class VerifySignature(Action):
     def __init__(self):
         Action.__init__(self, _("Verify Signature"))
 
+    def is_async(self):
+        return True
+
     def activate(self, leaf):
-        cli = ["gpg", "--verify", "--batch"]
-        p = subprocess.Popen(
-            cli,
-            stdout=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate(leaf.object)
-        uiutils.show_text_result(
-            stdout or stderr, title=_("Verification Result"))
+        return self.activate_multiple((leaf, ))
+
+    def activate_multiple(self, objects):
+        return support.VerifyTask(
+            backend.get_backend().verify,
+            ((_("Text %d") % num, obj.object)
+             for num, obj in enumerate(objects, 1)))
 
     def item_types(self):
         yield TextLeaf
@@ -214,9 +204,9 @@ class DecryptText(Action):
         return True
 
     def activate(self, leaf):
-        cli = ["gpg", "--decrypt", "--batch"]
-        self.async_token, task = _create_gpg_task(cli, leaf.object,
-                                                  self._finish_callback)
+        self.async_token, task = _create_gpg_task(
+            backend.get_backend().decrypt, (leaf.object, ),
+            self._finish_callback)
         return task
 
     def item_types(self):
@@ -241,9 +231,9 @@ class EncryptTextSymmetric(Action):
         return True
 
     def activate(self, leaf):
-        cli = ["gpg", "--symmetric", "--armor", "--batch"]
-        self.async_token, task = _create_gpg_task(cli, leaf.object,
-                                                  self._finish_callback)
+        self.async_token, task = _create_gpg_task(
+            backend.get_backend().encrypt_symmetric, (leaf.object, ),
+            self._finish_callback)
         return task
 
     def item_types(self):
@@ -2,32 +2,64 @@
 '''
 Lookup TextLeaf in StarDict dictionares.
 
-Require: pyStarDict https://github.com/lig/pystardict
+Dictionaries are read directly; dictionaries with compressed index
+(.idx.gz) require pyStarDict https://github.com/lig/pystardict
 
 '''
 __kupfer_name__ = _("StarDict")
-__kupfer_actions__ = ("Lookup", )
+__kupfer_actions__ = ("Lookup", "LookupAll")
+__kupfer_text_sources__ = ("SuggestionsSource", )
 __description__ = _("Lookup text with StarDict.\nPlugin require installed "
                     "dictionaries in StarDict format.")
 __version__ = "2011-07-07"
 __author__ = "Karol Będkowski <karol.bedkowski@gmail.com>"
 
 import os
-import re
-
-from kupfer.objects import Source, Action, TextLeaf, Leaf
+import threading
+import time
+from collections import OrderedDict
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from kupfer.objects import Source, Action, TextLeaf, Leaf, TextSource
+from kupfer import config
 from kupfer import icons
 from kupfer import plugin_support
+from kupfer import pretty
+from kupfer.obj.helplib import FilesystemWatchMixin
 
 import pystardict
 
+import stardict_support as support
+
 __kupfer_settings__ = plugin_support.PluginSettings({
     'key': 'dictdirs',
     'label': _("Dictionaries location (;-separated):"),
     'type': str,
     'value': "/usr/share/stardict/dic/",
+}, {
+    'key': 'cache_size',
+    'label': _("Number of dictionaries kept open:"),
+    'type': int,
+    'value': 4,
+}, {
+    'key': 'suggest',
+    'label': _("Suggest dictionary words when typing"),
+    'type': bool,
+    'value': False,
 }, )
 
+# max number of suggested words from one dictionary
+_SUGGESTIONS_LIMIT = 5
+# max number of dictionaries searched at once
+_LOOKUP_WORKERS = 4
+# time limit for lookup in one dictionary (sec)
+_LOOKUP_TIMEOUT = 3
+# number of cached lookup results
+_RESULTS_CACHE_SIZE = 100
+
 
 class Lookup(Action):
     def __init__(self):
@@ -59,7 +91,7 @@ class Lookup(Action):
         yield Dictionary
 
     def object_source(self, for_item=None):
-        return DictSource()
+        return _dict_source()
 
 
 class _LookupSource(Source):
@@ -72,17 +104,114 @@ class _LookupSource(Source):
         return (hash(self._text), self._dict)
 
     def get_items(self):
-        for translation in _lookup(self._dict.object, self._text):
-            translation = translation.strip()
-            if translation:
-                yield TranslationLeaf(translation,
-                                      _("%s in %s") %
-                                      (self._text, self._dict))
+        return _RESULTS.get(self._dict, self._text)
+
+
+class LookupAll(Action):
+    def __init__(self):
+        Action.__init__(self, _("Lookup In All Dictionaries"))
+
+    def activate(self, leaf):
+        return _LookupAllSource(str(leaf.object))
+
+    def is_factory(self):
+        return True
+
+    def item_types(self):
+        yield TextLeaf
+
+    def valid_for_item(self, leaf):
+        return len(leaf.object.strip()) > 0
+
+    def get_description(self):
+        return _("Lookup text in all StarDict dictionaries")
+
+    def get_icon_name(self):
+        return "accessories-dictionary"
+
+
+class _LookupAllSource(Source):
+    def __init__(self, text):
+        Source.__init__(self, name=_("Lookup into all dictionaries"))
+        self._text = text
+
+    def repr_key(self):
+        return hash(self._text)
+
+    def get_items(self):
+        dictionaries = _dict_source().get_items()
+        for _dictionary, translations in _lookup_all(dictionaries,
+                                                     self._text):
+            for translation in translations:
+                yield translation
+
+
+class LookupWord(Action):
+    def __init__(self):
+        Action.__init__(self, _("Lookup"))
+
+    def activate(self, leaf):
+        return _LookupSource(leaf.object, leaf.dictionary)
+
+    def is_factory(self):
+        return True
+
+    def get_description(self):
+        return _("Lookup word in dictionary")
+
+    def get_icon_name(self):
+        return "accessories-dictionary"
+
+
+class WordLeaf(TextLeaf):
+    ''' Headword from dictionary '''
+
+    def __init__(self, word, dictionary):
+        TextLeaf.__init__(self, word)
+        self.dictionary = dictionary
+
+    def get_actions(self):
+        yield LookupWord()
+
+    def get_description(self):
+        return _("Word in %s") % self.dictionary
+
+    def get_icon_name(self):
+        return "accessories-dictionary"
+
+
+class SuggestionsSource(TextSource):
+    def __init__(self):
+        TextSource.__init__(self, name=_("Dictionary Words"))
+
+    def get_text_items(self, text):
+        text = text.strip()
+        if not __kupfer_settings__['suggest'] or len(text) < 2:
+            return
+        word = text.encode('utf-8') if not isinstance(text, bytes) else text
+        for dictionary, sdict in _SUGGEST_DICTIONARIES.get_all(
+                _dict_source().get_items()):
+            for headword in sdict.suggest(word, _SUGGESTIONS_LIMIT):
+                yield WordLeaf(headword.decode('utf-8', 'replace'),
+                               dictionary)
+
+    def provides(self):
+        yield WordLeaf
 
 
 class Dictionary(Leaf):
     serializable = 1
 
+    def __init__(self, path, name, info=None):
+        Leaf.__init__(self, path, name)
+        self.info = info or {}
+
+    def get_description(self):
+        wordcount = self.info.get('wordcount')
+        if wordcount:
+            return _("%s words") % wordcount
+        return None
+
     def get_gicon(self):
         return icons.ComposedIcon("text-x-generic",
                                   "preferences-desktop-locale")
@@ -97,20 +226,46 @@ class TranslationLeaf(TextLeaf):
         return self._descrtiption or TextLeaf.get_description(self)
 
 
-# cache for Languages (load it once)
-_DICT_CACHE = None
+# cache for Languages: (directories state, Dictionary leaves)
+_DICT_CACHE = (None, ())
+# found dictionaries: directory -> (mtime, {ifo file: (mtime, info)})
+_DIRS_CACHE = {}
+
 
+class DictSource(Source, FilesystemWatchMixin):
+    ''' Installed dictionaries; use shared instance from _dict_source() '''
 
-class DictSource(Source):
     def __init__(self):
         Source.__init__(self, _("Languages"))
+        self.monitor_token = None
+        self._setting_handler = None
+
+    def initialize(self):
+        self.finalize()
+        self.monitor_token = self.monitor_directories(*_get_dict_dirs())
+        self._setting_handler = __kupfer_settings__.connect(
+            "plugin-setting-changed", self._setting_changed)
+
+    def finalize(self):
+        if self.monitor_token is not None:
+            self.stop_monitor_fs_changes(self.monitor_token)
+            self.monitor_token = None
+        if self._setting_handler is not None:
+            __kupfer_settings__.disconnect(self._setting_handler)
+            self._setting_handler = None
+
+    def monitor_include_file(self, gfile):
+        return gfile and gfile.get_basename().endswith('.ifo')
 
     def get_items(self):
         global _DICT_CACHE
-        if not _DICT_CACHE:
-            _DICT_CACHE = tuple((Dictionary(name, key)
-                                 for key, name in _load_dictionares()))
-        return _DICT_CACHE
+        dictionaries = list(_load_dictionares())
+        state = tuple((path, info.get('_mtime'))
+                      for _name, path, info in dictionaries)
+        if state != _DICT_CACHE[0]:
+            _DICT_CACHE = (state, tuple(Dictionary(path, name, info)
+                                        for name, path, info in dictionaries))
+        return _DICT_CACHE[1]
 
     def provides(self):
         yield Dictionary
@@ -118,35 +273,276 @@ class DictSource(Source):
     def get_icon_name(self):
         return "preferences-desktop-locale"
 
+    def _setting_changed(self, settings, key, value):
+        if key == 'dictdirs':
+            if self.monitor_token is not None:
+                self.stop_monitor_fs_changes(self.monitor_token)
+            self.monitor_token = self.monitor_directories(*_get_dict_dirs())
+            self.mark_for_update()
 
-def _load_dictionares():
+
+_DICT_SOURCE = None
+
+
+def _dict_source():
+    ''' Get shared DictSource '''
+    global _DICT_SOURCE
+    if _DICT_SOURCE is None:
+        _DICT_SOURCE = DictSource()
+    return _DICT_SOURCE
+
+
+def _get_dict_dirs():
     dirs = __kupfer_settings__['dictdirs']
     if not dirs:
-        return
-    for dictdir in dirs.split(';'):
-        if not os.path.isdir(dictdir):
+        return []
+    return [os.path.expanduser(dictdir.strip())
+            for dictdir in dirs.split(';') if dictdir.strip()]
+
+
+def _load_dictionares():
+    ''' Find dictionaries in configured directories.
+    Yield (name, path without extension, ifo info). '''
+    for dictdir in _get_dict_dirs():
+        for ifopath, info in sorted(_scan_directory(dictdir).items()):
+            name = info.get('bookname')
+            if name:
+                yield name, ifopath[:-4], info
+
+
+def _scan_directory(dictdir):
+    ''' Find .ifo files in `dictdir`; return dict ifo path -> info.
+    Directory is scanned only when it was modified; only new or modified
+    .ifo files are parsed. '''
+    try:
+        mtime = os.path.getmtime(dictdir)
+    except OSError:
+        _DIRS_CACHE.pop(dictdir, None)
+        return {}
+    cached_mtime, cached = _DIRS_CACHE.get(dictdir, (None, {}))
+    if mtime == cached_mtime:
+        return cached
+    found = {}
+    for filename in os.listdir(dictdir):
+        if not filename.endswith('.ifo'):
             continue
-        for filename in os.listdir(dictdir):
-            if not filename.endswith('.ifo'):
-                continue
-            ifopath = os.path.join(dictdir, filename)
+        ifopath = os.path.join(dictdir, filename)
+        try:
+            ifo_mtime = os.path.getmtime(ifopath)
+            info = cached.get(ifopath)
+            if info is None or info['_mtime'] != ifo_mtime:
+                info = support.read_ifo(ifopath)
+                info['_mtime'] = ifo_mtime
+            found[ifopath] = info
+        except (IOError, OSError, ValueError) as err:
+            pretty.print_debug(__name__, 'invalid dictionary', ifopath, err)
+    _DIRS_CACHE[dictdir] = (mtime, found)
+    return found
+
+
+class _DictionaryCache(object):
+    ''' LRU cache of opened dictionaries. Entry is invalidated when
+    dictionary index or data file is modified. '''
+
+    def __init__(self):
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        stamp = _dictionary_stamp(path)
+        with self._lock:
+            entry = self._cache.get(path)
+        if entry is None or entry[0] != stamp:
+            entry = (stamp, _open_dictionary(path))
+        with self._lock:
+            self._cache.pop(path, None)
+            self._cache[path] = entry
+            limit = max(1, __kupfer_settings__['cache_size'])
+            while len(self._cache) > limit:
+                self._cache.popitem(last=False)
+        return entry[1]
+
+
+class _SuggestDictionaries(object):
+    ''' Dictionaries opened for suggestions. They are kept open while
+    installed and not modified, independently of lookup LRU cache, so
+    typing does not reopen them. Dictionaries are opened (and indexes
+    built) one by one on background thread; not yet opened dictionaries
+    are skipped. Dictionaries that can't be read directly (pystardict) are
+    never opened. '''
+
+    def __init__(self):
+        # path -> (stamp, StarDict or None when open failed)
+        self._cache = {}
+        # (path, stamp) waiting for open
+        self._pending = []
+        self._opener_running = False
+        self._lock = threading.Lock()
+
+    def get_all(self, dictionaries):
+        ''' Return list of (Dictionary, StarDict) for opened `dictionaries`;
+        schedule opening of others. '''
+        with self._lock:
+            cache = {}
+            result = []
+            pending = [path for path, _stamp in self._pending]
+            for dictionary in dictionaries:
+                path = dictionary.object
+                if not support.can_open(path):
+                    continue
+                stamp = _dictionary_stamp(path)
+                entry = self._cache.get(path)
+                if entry is None or entry[0] != stamp:
+                    if path not in pending:
+                        self._schedule(path, stamp)
+                    continue
+                cache[path] = entry
+                if entry[1] is not None:
+                    result.append((dictionary, entry[1]))
+            # close dictionaries no longer installed
+            self._cache = cache
+        return result
+
+    def _schedule(self, path, stamp):
+        ''' Schedule opening of `path`; must be called with lock held '''
+        self._pending.append((path, stamp))
+        if not self._opener_running:
+            self._opener_running = True
+            thread = threading.Thread(target=self._open_pending)
+            thread.daemon = True
+            thread.start()
+
+    def _open_pending(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._opener_running = False
+                    return
+                path, stamp = self._pending[0]
             try:
-                with open(ifopath, 'rt') as ifo:
-                    for line in ifo:
-                        if line.startswith('bookname'):
-                            name = line.split('=')[1].strip()
-                            yield name, ifopath[:-4]
-            except:
-                pass
+                sdict = support.StarDict(path, _index_cache())
+            except (IOError, OSError, ValueError) as err:
+                pretty.print_debug(__name__, 'open dictionary', path,
+                                   'failed:', err)
+                # don't retry until dictionary is changed
+                sdict = None
+            with self._lock:
+                self._pending.pop(0)
+                self._cache[path] = (stamp, sdict)
 
 
-_RE_CLEAN = re.compile(r'<\/?.+?>')
+def _index_cache():
+    return support.IndexCache(
+        os.path.join(config.get_cache_home(), 'stardict'))
+
+
+def _open_dictionary(path):
+    if support.can_open(path):
+        return support.StarDict(path, _index_cache())
+    return pystardict.Dictionary(path)
+
+
+def _dictionary_stamp(path):
+    stamp = []
+    for ext in ('.idx', '.idx.gz', '.dict', '.dict.dz'):
+        try:
+            stamp.append(os.path.getmtime(path + ext))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+class _ResultsCache(object):
+    ''' LRU cache of lookup results (TranslationLeaf lists) by dictionary
+    and word. '''
+
+    def __init__(self):
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, dictionary, word):
+        key = (dictionary.object, word)
+        stamp = _dictionary_stamp(dictionary.object)
+        with self._lock:
+            entry = self._cache.pop(key, None)
+            if entry is not None and entry[0] == stamp:
+                self._cache[key] = entry
+                return entry[1]
+        descr = _("%s in %s") % (word, dictionary)
+        leaves = [TranslationLeaf(translation.strip(), descr)
+                  for translation in _lookup(dictionary.object, word)
+                  if translation.strip()]
+        with self._lock:
+            self._cache[key] = (stamp, leaves)
+            while len(self._cache) > _RESULTS_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return leaves
+
+
+_DICTIONARIES = _DictionaryCache()
+_SUGGEST_DICTIONARIES = _SuggestDictionaries()
+_RESULTS = _ResultsCache()
 
 
 def _lookup(dictionary, word):
-    sdict = pystardict.Dictionary(dictionary)
-    if word in sdict:
-        data = sdict[word].replace('<br>', '\n').replace('\0', '\n')
-        data = re.sub(_RE_CLEAN, '', data)
-        return data.split('\n')
-    return []
+    sdict = _DICTIONARIES.get(dictionary)
+    if isinstance(sdict, support.StarDict):
+        if not isinstance(word, bytes):
+            word = word.encode('utf-8')
+        data = u'\n'.join(support.render_article(article)
+                          for article in sdict.lookup(word))
+    elif word in sdict:
+        article = sdict[word]
+        if isinstance(article, bytes):
+            # pystardict returns raw bytes
+            article = article.decode('utf-8', 'replace')
+        data = support.strip_markup(article.replace(u'\0', u'\n'))
+    else:
+        return []
+    return data.split('\n')
+
+
+def _lookup_all(dictionaries, word):
+    ''' Lookup `word` in all `dictionaries` in parallel (at most
+    _LOOKUP_WORKERS at once). Yield (dictionary, translations) in order of
+    finish.
+
+    Each dictionary has own deadline (_LOOKUP_TIMEOUT seconds); too slow
+    dictionaries are skipped and their workers abandoned, so remaining
+    dictionaries are looked up by new workers. '''
+    results = queue.Queue()
+
+    def worker(num):
+        try:
+            result = _RESULTS.get(dictionaries[num], word)
+        except Exception as err:
+            pretty.print_error(__name__, 'lookup in', dictionaries[num],
+                               'failed:', err)
+            result = []
+        results.put((num, result))
+
+    # num -> deadline of running lookups
+    running = {}
+    next_num = 0
+    while next_num < len(dictionaries) or running:
+        while next_num < len(dictionaries) and \
+                len(running) < _LOOKUP_WORKERS:
+            thread = threading.Thread(target=worker, args=(next_num, ))
+            thread.daemon = True
+            thread.start()
+            running[next_num] = time.time() + _LOOKUP_TIMEOUT
+            next_num += 1
+        timeout = min(running.values()) - time.time()
+        try:
+            num, result = results.get(timeout=max(timeout, 0.01))
+        except queue.Empty:
+            now = time.time()
+            for num, deadline in list(running.items()):
+                if deadline <= now:
+                    pretty.print_info(__name__, 'lookup timeout for',
+                                      dictionaries[num])
+                    del running[num]
+            continue
+        if running.pop(num, None) is not None:
+            yield dictionaries[num], result
+
@@ -0,0 +1,567 @@
+# -*- coding: UTF-8 -*-
+''' StarDict dictionaries support functions.
+
+Dictionary index (.idx) is memory-mapped and searched by binary search;
+only article data for found words is read from .dict file. Compressed data
+files (.dict.dz) are read by chunks when they are in dictzip format.
+Compiled index structures may be stored in IndexCache and loaded by mmap.
+When exact headword is not found, words are searched by normalized
+(case-folded and without diacritics) key in headwords and synonyms.
+'''
+
+__version__ = "2026-10-19"
+__author__ = "Karol Będkowski <karol.bedkowski@gmail.com>"
+
+import array
+import gzip
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict
+try:
+    from html import unescape
+except ImportError:
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+IFO_HEADER = b"StarDict's dict ifo file"
+# field types that contain plain text
+TEXT_TYPES = 'mltywn'
+# field types that contain markup
+MARKUP_TYPES = 'ghxk'
+# tags rendered as line break
+_BREAK_TAGS = frozenset(('br', 'p', 'div', 'li', 'tr', 'dd', 'dt', 'def',
+                         'blockquote', 'ex'))
+# number of decompressed dictzip chunks kept in memory
+DICTZIP_CACHE_SIZE = 32
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_GZIP_FHCRC = 2
+_GZIP_FEXTRA = 4
+_GZIP_FNAME = 8
+_GZIP_FCOMMENT = 16
+
+INDEX_CACHE_VERSION = 2
+# arrays stored in index cache
+_INDEX_ARRAYS = ('offsets', 'syn_offsets', 'normalized')
+_INDEX_CACHE_MAGIC = b'KSDI'
+# magic, version, number of arrays, length of cache key
+_INDEX_CACHE_HEADER = struct.Struct('<4sHHI')
+# name, typecode, item size, number of items, data offset
+_INDEX_CACHE_ARRAY = struct.Struct('<16scBQQ')
+
+
+def read_ifo(filename):
+    ''' Read dictionary description (.ifo) file; return dict of options '''
+    info = {}
+    with open(filename, 'rb') as ifo:
+        if not ifo.readline().startswith(IFO_HEADER):
+            raise ValueError('invalid ifo file: %s' % filename)
+        for line in ifo:
+            key, sep, value = line.partition(b'=')
+            if sep:
+                info[key.strip().decode('utf-8', 'replace')] = \
+                    value.strip().decode('utf-8', 'replace')
+    return info
+
+
+def can_open(path):
+    ''' Check is dictionary `path` (without extension) can be opened by
+    StarDict '''
+    return os.path.isfile(path + '.idx') and (
+        os.path.isfile(path + '.dict') or os.path.isfile(path + '.dict.dz'))
+
+
+class StarDict(object):
+    ''' StarDict dictionary; `path` is path to dictionary files without
+    extension. '''
+
+    def __init__(self, path, index_cache=None):
+        self.path = path
+        self.info = read_ifo(path + '.ifo')
+        self._offset_size = 8 if self.info.get('idxoffsetbits') == '64' \
+            else 4
+        self._idx = _map_file(path + '.idx')
+        self._syn = _map_file(path + '.syn') \
+            if os.path.isfile(path + '.syn') else b''
+        self._data = _open_data(path)
+        stamp = _index_stamp(path)
+        arrays = index_cache.load(path, stamp) if index_cache else None
+        if not arrays or any(name not in arrays for name in _INDEX_ARRAYS):
+            arrays = self._build_index()
+            if index_cache:
+                index_cache.save(path, stamp, arrays)
+        # positions of index and synonyms entries
+        self._offsets = arrays['offsets']
+        self._syn_offsets = arrays['syn_offsets']
+        # references to index entries (< len(self)) and synonyms entries
+        # (>= len(self)) sorted by normalized word
+        self._normalized = arrays['normalized']
+
+    def _build_index(self):
+        self._offsets = _build_offsets(self._idx, self._offset_size + 4)
+        self._syn_offsets = _build_offsets(self._syn, 4)
+        normalized = list(range(len(self._offsets) + len(self._syn_offsets)))
+        normalized.sort(key=lambda ref: normalize(self._ref_word(ref)))
+        return {'offsets': self._offsets,
+                'syn_offsets': self._syn_offsets,
+                'normalized': array.array(self._offsets.typecode,
+                                          normalized)}
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def word(self, index):
+        ''' Get headword of `index` entry '''
+        start = self._offsets[index]
+        return self._idx[start:self._idx.find(b'\0', start)]
+
+    def entry(self, index):
+        ''' Get (headword, data offset, data size) of `index` entry '''
+        start = self._offsets[index]
+        end = self._idx.find(b'\0', start)
+        if self._offset_size == 8:
+            offset, size = struct.unpack_from('>QI', self._idx, end + 1)
+        else:
+            offset, size = struct.unpack_from('>II', self._idx, end + 1)
+        return self._idx[start:end], offset, size
+
+    def find(self, word):
+        ''' Find first entry for `word`; return entry index or -1 '''
+        index = self._bisect(_sort_key, _sort_key(word))
+        if index < len(self._offsets) and self.word(index) == word:
+            return index
+        return -1
+
+    def find_normalized(self, word):
+        ''' Find entries for `word` ignoring case and diacritics, including
+        synonyms; return list of entries indexes. '''
+        key = normalize(word)
+        pos = self._bisect(normalize, key, refs=self._normalized)
+        indexes = []
+        while pos < len(self._normalized):
+            ref = self._normalized[pos]
+            if normalize(self._ref_word(ref)) != key:
+                break
+            index = self._ref_index(ref)
+            if index not in indexes:
+                indexes.append(index)
+            pos += 1
+        return indexes
+
+    def prefix_range(self, prefix):
+        ''' Find entries which headwords starts with `prefix` (ignoring
+        ascii case); return (first, last + 1) index. '''
+        prefix = prefix.lower()
+        plen = len(prefix)
+        start = self._bisect(lambda word: word.lower(), prefix)
+        end = self._bisect(lambda word: word[:plen].lower(), prefix, True)
+        return start, max(start, end)
+
+    def suggest(self, word, limit=10, max_distance=2, window=500):
+        ''' Find headwords similar to `word`: starting with `word` or
+        within `max_distance` edits. Fuzzy matches are searched only in
+        `window` entries around position of `word` in index.
+        Return up to `limit` headwords sorted by closeness. '''
+        # allow less errors in short words
+        max_distance = min(max_distance, len(word) // 3)
+        found = {}
+        start, end = self.prefix_range(word)
+        for index in range(start, min(end, start + limit)):
+            headword = self.word(index)
+            found[headword] = (0, len(headword) - len(word))
+
+        if max_distance:
+            uword = word.decode('utf-8', 'replace').lower()
+            first = max(0, start - window)
+            last = min(len(self._offsets), start + window)
+            for index in range(first, last):
+                headword = self.word(index)
+                if headword in found:
+                    continue
+                dist = edit_distance(
+                    uword, headword.decode('utf-8', 'replace').lower(),
+                    max_distance)
+                if dist <= max_distance:
+                    found[headword] = (dist, 0)
+
+        return sorted(found, key=lambda hword: (found[hword], hword))[:limit]
+
+    def _ref_word(self, ref):
+        if ref < len(self._offsets):
+            return self.word(ref)
+        start = self._syn_offsets[ref - len(self._offsets)]
+        return self._syn[start:self._syn.find(b'\0', start)]
+
+    def _ref_index(self, ref):
+        if ref < len(self._offsets):
+            return ref
+        start = self._syn_offsets[ref - len(self._offsets)]
+        index, = struct.unpack_from('>I', self._syn,
+                                    self._syn.find(b'\0', start) + 1)
+        return index
+
+    def _bisect(self, keyfunc, key, right=False, refs=None):
+        ''' Find position of `key` in index (or in `refs` array); compared
+        are values of `keyfunc` for headwords '''
+        lo, hi = 0, len(self._offsets if refs is None else refs)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mkey = keyfunc(self.word(mid) if refs is None
+                           else self._ref_word(refs[mid]))
+            if mkey < key or (right and mkey == key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def lookup(self, word):
+        ''' Find articles for `word`; return list of articles; each article
+        is list of (type, data) fields. '''
+        index = self.find(word)
+        if index < 0:
+            return [self.article(*self.entry(index)[1:])
+                    for index in self.find_normalized(word)]
+        articles = []
+        while index < len(self._offsets):
+            headword, offset, size = self.entry(index)
+            if headword != word:
+                break
+            articles.append(self.article(offset, size))
+            index += 1
+        return articles
+
+    def article(self, offset, size):
+        ''' Read and parse article data '''
+        return parse_article(self._data[offset:offset + size],
+                             self.info.get('sametypesequence'))
+
+
+class IndexCache(object):
+    ''' Persistent storage for compiled dictionary indexes.
+
+    Each dictionary has own file in `directory` with named arrays. File is
+    valid only for the same index file size and mtime; arrays are loaded by
+    mmap. '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def load(self, path, stamp):
+        ''' Load arrays for dictionary `path`; return dict name -> array or
+        None when there is no valid cache. '''
+        filename = self._filename(path)
+        try:
+            data = _map_file(filename)
+            return _read_index_cache(data, _index_cache_key(path, stamp))
+        except (IOError, OSError, ValueError, struct.error):
+            return None
+
+    def save(self, path, stamp, arrays):
+        ''' Save `arrays` (dict name -> array.array) for dictionary
+        `path`. '''
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmpname = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as outfile:
+                _write_index_cache(outfile, _index_cache_key(path, stamp),
+                                   arrays)
+            os.rename(tmpname, self._filename(path))
+        except (IOError, OSError):
+            return False
+        return True
+
+    def _filename(self, path):
+        name = hashlib.sha1(os.path.abspath(path).encode('utf-8'))
+        return os.path.join(self.directory, '%s.v%d.idxcache' %
+                            (name.hexdigest(), INDEX_CACHE_VERSION))
+
+
+class DictZip(object):
+    ''' Random access reader for dictzip (.dict.dz) files.
+
+    Only chunks covering requested data are decompressed; recently used
+    chunks are kept in LRU cache. '''
+
+    def __init__(self, filename):
+        self._file = _map_file(filename)
+        self._chunk_len, self._chunks = _read_dictzip_header(self._file)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        return self.read(key.start or 0, key.stop - (key.start or 0))
+
+    def read(self, offset, size):
+        ''' Read `size` bytes of decompressed data from `offset` '''
+        if size <= 0:
+            return b''
+        first = offset // self._chunk_len
+        last = min((offset + size - 1) // self._chunk_len,
+                   len(self._chunks) - 1)
+        data = b''.join(self._chunk(num) for num in range(first, last + 1))
+        start = offset - first * self._chunk_len
+        return data[start:start + size]
+
+    def _chunk(self, num):
+        with self._lock:
+            data = self._cache.pop(num, None)
+            if data is None:
+                start, end = self._chunks[num]
+                data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(
+                    self._file[start:end])
+            self._cache[num] = data
+            while len(self._cache) > DICTZIP_CACHE_SIZE:
+                self._cache.popitem(last=False)
+            return data
+
+
+def parse_article(data, sametypesequence=None):
+    ''' Split article `data` into list of (type, data) fields '''
+    fields = []
+    pos = 0
+    if sametypesequence:
+        last = len(sametypesequence) - 1
+        for num, ftype in enumerate(sametypesequence):
+            if num == last:
+                # size or terminator of last field is omitted
+                fields.append((ftype, data[pos:]))
+                break
+            pos = _read_field(data, pos, ftype, fields)
+        return fields
+
+    while pos < len(data):
+        ftype = data[pos:pos + 1].decode('ascii', 'replace')
+        pos = _read_field(data, pos + 1, ftype, fields)
+    return fields
+
+
+def render_article(fields):
+    ''' Convert text and markup fields of article into plain text; other
+    fields (resources, sounds, images) are skipped. '''
+    texts = []
+    for ftype, data in fields:
+        if ftype in TEXT_TYPES:
+            texts.append(data.decode('utf-8', 'replace'))
+        elif ftype in MARKUP_TYPES:
+            texts.append(strip_markup(data.decode('utf-8', 'replace')))
+    return u'\n'.join(texts)
+
+
+def strip_markup(text):
+    ''' Remove tags from `text` in one pass; block tags are replaced by
+    line break and entities are unescaped. '''
+    out = []
+    pos = 0
+    find = text.find
+    while True:
+        start = find(u'<', pos)
+        if start < 0:
+            out.append(text[pos:])
+            break
+        out.append(text[pos:start])
+        end = find(u'>', start)
+        if end < 0:
+            # not closed tag
+            out.append(text[start:])
+            break
+        tag = text[start + 1:end].strip(u' /').split(None, 1)
+        if tag and tag[0].lower() in _BREAK_TAGS:
+            out.append(u'\n')
+        pos = end + 1
+    return unescape(u''.join(out))
+
+
+def normalize(word):
+    ''' Create case-folded key without diacritics for `word` (bytes) '''
+    text = word.decode('utf-8', 'replace')
+    text = text.casefold() if hasattr(text, 'casefold') else text.lower()
+    return u''.join(char for char in unicodedata.normalize('NFKD', text)
+                    if not unicodedata.combining(char))
+
+
+def edit_distance(first, second, limit):
+    ''' Edit distance (with transpositions) between `first` and `second`;
+    computation stop when distance exceed `limit` and limit + 1 is
+    returned. '''
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(len(second) + 1))
+    for num, chr1 in enumerate(first, 1):
+        curr = [num]
+        for num2, chr2 in enumerate(second, 1):
+            dist = min(prev[num2] + 1, curr[num2 - 1] + 1,
+                       prev[num2 - 1] + (chr1 != chr2))
+            if (num > 1 and num2 > 1 and chr1 == second[num2 - 2] and
+                    first[num - 2] == chr2):
+                dist = min(dist, prev2[num2 - 2] + 1)
+            curr.append(dist)
+        if min(curr) > limit:
+            return limit + 1
+        prev2, prev = prev, curr
+    return prev[-1]
+
+
+def _read_field(data, pos, ftype, fields):
+    if ftype.islower():
+        # text terminated by \0
+        end = data.find(b'\0', pos)
+        if end < 0:
+            end = len(data)
+        fields.append((ftype, data[pos:end]))
+        return end + 1
+    # binary data prefixed by size
+    size, = struct.unpack_from('>I', data, pos)
+    pos += 4
+    fields.append((ftype, data[pos:pos + size]))
+    return pos + size
+
+
+def _sort_key(word):
+    ''' Key for StarDict headwords ordering: ascii case-insensitive
+    comparison, then byte comparison. '''
+    return word.lower(), word
+
+
+def _map_file(filename):
+    with open(filename, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _open_data(path):
+    if os.path.isfile(path + '.dict'):
+        return _map_file(path + '.dict')
+    try:
+        return DictZip(path + '.dict.dz')
+    except ValueError:
+        # plain gzip file; no random access
+        with gzip.open(path + '.dict.dz', 'rb') as infile:
+            return infile.read()
+
+
+def _read_dictzip_header(data):
+    ''' Parse gzip header with dictzip random access field.
+    Return chunk length and list of (start, end) positions of compressed
+    chunks. '''
+    if data[:2] != _GZIP_MAGIC:
+        raise ValueError('not gzip file')
+    flags = ord(data[3:4])
+    if not flags & _GZIP_FEXTRA:
+        raise ValueError('missing dictzip header')
+    xlen, = struct.unpack_from('<H', data, 10)
+    pos = 12
+    extra_end = pos + xlen
+    chunk_len = chunk_sizes = None
+    while pos + 4 <= extra_end:
+        subfield = data[pos:pos + 2]
+        sublen, = struct.unpack_from('<H', data, pos + 2)
+        if subfield == b'RA':
+            _ver, chunk_len, count = struct.unpack_from('<HHH', data, pos + 4)
+            chunk_sizes = struct.unpack_from('<%dH' % count, data, pos + 10)
+        pos += 4 + sublen
+    if not chunk_len:
+        raise ValueError('missing dictzip header')
+    pos = extra_end
+    if flags & _GZIP_FNAME:
+        pos = data.find(b'\0', pos) + 1
+    if flags & _GZIP_FCOMMENT:
+        pos = data.find(b'\0', pos) + 1
+    if flags & _GZIP_FHCRC:
+        pos += 2
+    chunks = []
+    for size in chunk_sizes:
+        chunks.append((pos, pos + size))
+        pos += size
+    return chunk_len, chunks
+
+
+def _index_stamp(path):
+    stamp = []
+    for ext in ('.idx', '.syn'):
+        try:
+            fstat = os.stat(path + ext)
+            stamp.append((fstat.st_size, fstat.st_mtime))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+def _index_cache_key(path, stamp):
+    return repr((os.path.abspath(path), stamp)).encode('utf-8')
+
+
+def _write_index_cache(outfile, key, arrays):
+    outfile.write(_INDEX_CACHE_HEADER.pack(
+        _INDEX_CACHE_MAGIC, INDEX_CACHE_VERSION, len(arrays), len(key)))
+    outfile.write(key)
+    offset = _align(_INDEX_CACHE_HEADER.size + len(key) +
+                    _INDEX_CACHE_ARRAY.size * len(arrays))
+    for name, arr in sorted(arrays.items()):
+        outfile.write(_INDEX_CACHE_ARRAY.pack(
+            name.encode('ascii'), arr.typecode.encode('ascii'), arr.itemsize,
+            len(arr), offset))
+        offset = _align(offset + arr.itemsize * len(arr))
+    for _name, arr in sorted(arrays.items()):
+        outfile.write(b'\0' * (_align(outfile.tell()) - outfile.tell()))
+        arr.tofile(outfile)
+
+
+def _read_index_cache(data, key):
+    magic, version, count, keylen = _INDEX_CACHE_HEADER.unpack_from(data, 0)
+    pos = _INDEX_CACHE_HEADER.size
+    if magic != _INDEX_CACHE_MAGIC or version != INDEX_CACHE_VERSION or \
+            data[pos:pos + keylen] != key:
+        return None
+    pos += keylen
+    arrays = {}
+    for _num in range(count):
+        name, typecode, itemsize, length, offset = \
+            _INDEX_CACHE_ARRAY.unpack_from(data, pos)
+        pos += _INDEX_CACHE_ARRAY.size
+        typecode = typecode.decode('ascii')
+        if array.array(typecode).itemsize != itemsize or \
+                offset + itemsize * length > len(data):
+            return None
+        arrays[name.rstrip(b'\0').decode('ascii')] = _array_view(
+            data, typecode, offset, itemsize * length)
+    return arrays
+
+
+def _array_view(data, typecode, offset, size):
+    ''' Create array from `data` slice; without copying when possible. '''
+    if hasattr(memoryview, 'cast'):
+        return memoryview(data)[offset:offset + size].cast(typecode)
+    arr = array.array(typecode)
+    arr.fromstring(data[offset:offset + size])
+    return arr
+
+
+def _align(pos, alignment=8):
+    return (pos + alignment - 1) // alignment * alignment
+
+
+def _build_offsets(idx, data_size):
+    ''' Build array of positions of entries in index (.idx or .syn).
+    Each entry is word terminated by \0 and `data_size` bytes. '''
+    offsets = array.array('I' if len(idx) < 2 ** 32 else 'L')
+    tail = data_size + 1
+    end = len(idx)
+    find = idx.find
+    append = offsets.append
+    pos = 0
+    while pos < end:
+        nul = find(b'\0', pos)
+        if nul < 0:
+            break
+        append(pos)
+        pos = nul + tail
+    return offsets
@@ -2,6 +2,7 @@
 
 __kupfer_name__ = _("User Sources")
 __kupfer_sources__ = ("UserSourcesSource", )
+__kupfer_text_sources__ = ("UserQuerySource", )
 __description__ = _("User defined sources")
 __version__ = "2010-05-12"
 __author__ = "Karol Będkowski <karol.bedkowski@gmail.com>"
@@ -18,28 +19,64 @@ dynamic=True
 file=~/test.txt
 type=text
 
+[Grep notes]
+command=grep -i {query} ~/notes.txt
+type=text
+
 
 Fields:
 	section: source name
 	command: command do execute
 	file: text file name to read
 	description: optional description for the source
-	type: type of the resultat: text, one-text, url, file
+	type: type of the resultat: text, one-text, url, file, jsonl, tsv
 	dynamic: is source is dynamic
+	max_items: optional limit of items read from command output; command is
+		terminated when limit is reached
 
 	Command of file must be defined.
+	Command containing {query} is run for text entered by user. Text is
+	passed to shell as positional parameter and {query} is replaced by "$1",
+	so text is never interpreted by shell (quotes around {query} are not
+	needed). Commands are started in background after short delay; command
+	for previous text is killed. Search waits up to one second for results;
+	results of slower commands are cached and shown when the text is
+	searched again.
+	File sources are watched for changes; only lines appended to file are
+	read on refresh. File is read again when it is truncated or replaced.
 	Each leaf created by given source has set attribute source_name.
+	Not dynamic sources are loaded in background after configuration change.
+	Statistics of last refresh of each source are available in "User
+	Sources Status".
+
+	Types jsonl and tsv allow to create various leaves by one source. Each
+	line of output is one record:
+		jsonl: {"type": "url", "object": "http://...", "name": "...",
+			"description": "..."}
+		tsv: type<TAB>object[<TAB>name[<TAB>description]]
+	Record type is one of: text, url, file; name and description are optional.
 '''
 from __future__ import with_statement
 
+import json
+import mmap
+import os
 import os.path
+import signal
 import subprocess
+import threading
+import time
 import ConfigParser
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import gobject
 
 from kupfer import config
+from kupfer import pretty
 from kupfer.obj import objects
-from kupfer.obj.base import Source
-from kupfer.obj.helplib import FilesystemWatchMixin
+from kupfer.obj.base import Source, TextSource
+from kupfer.obj.helplib import FilesystemWatchMixin, PicklingHelperMixin
 
 CONFIG_FILENAME = 'user_sources.cfg'
 RESULT_CLASSES = {
@@ -48,9 +85,31 @@ RESULT_CLASSES = {
     'text': objects.TextLeaf,
     'one-text': objects.TextLeaf,
 }
+# result types where each line describe own leaf
+STRUCTURED_TYPES = ('jsonl', 'tsv')
+try:
+    _STRING_TYPES = basestring
+except NameError:
+    _STRING_TYPES = (str, bytes)
 
 
-class UserSource(Source):
+# files larger than this are read by mmap
+_MMAP_THRESHOLD = 1024 * 1024
+# placeholder for text entered by user in query commands
+_QUERY_PLACEHOLDER = '{query}'
+# delay before query command is started (sec)
+_QUERY_DEBOUNCE = 0.25
+# max time search waits for results of query command (sec)
+_QUERY_WAIT = 1.0
+# max run time of query command (sec)
+_QUERY_TIMEOUT = 10
+# number of cached results for each query command
+_QUERY_CACHE_SIZE = 50
+# max number of sources refreshed at once
+_REFRESH_WORKERS = 4
+
+
+class UserSource(Source, FilesystemWatchMixin, PicklingHelperMixin):
     def __init__(self, name, command, filename):
         Source.__init__(self, name=name)
         self.result_type = 'text'
@@ -58,6 +117,47 @@ class UserSource(Source):
         self.filename = os.path.expanduser(filename) if filename else None
         self.dynamic = False
         self.description = _('User Source')
+        self.max_items = None
+        self.monitor_token = None
+        # state of followed file: (st_dev, st_ino), read offset, leaves for
+        # complete lines read so far (text read so far for one-text type)
+        self._file_id = None
+        self._file_offset = 0
+        self._file_leaves = []
+        self._file_text = b''
+        # statistics of last refresh
+        self.stats = None
+        # leaves from last command run by (output line, occurrence)
+        self._leaves = {}
+        # leaves from last refresh in order
+        self._last_items = None
+        self.unpickle_finish()
+
+    def pickle_prepare(self):
+        self.monitor_token = None
+        self._refresh_lock = None
+        self._prefetch = None
+        self._leaves = {}
+        self._last_items = None
+
+    def unpickle_finish(self):
+        self._refresh_lock = threading.Lock()
+        # _Prefetch of scheduled or finished background load
+        self._prefetch = None
+
+    def initialize(self):
+        self.finalize()
+        if self.filename and not self.command:
+            self.monitor_token = self.monitor_directories(
+                os.path.dirname(self.filename))
+
+    def finalize(self):
+        if self.monitor_token is not None:
+            self.stop_monitor_fs_changes(self.monitor_token)
+            self.monitor_token = None
+
+    def monitor_include_file(self, gfile):
+        return gfile and gfile.get_path() == self.filename
 
     def repr_key(self):
         return (self.name, self.command, self.filename)
@@ -66,41 +166,484 @@ class UserSource(Source):
         return self.dynamic
 
     def get_items(self):
+        with self._refresh_lock:
+            job = self._prefetch
+            if job is not None and job.done.is_set():
+                self._prefetch = None
+        if job is None:
+            return self._load_items()
+        if not job.done.is_set():
+            if self._last_items is not None:
+                # show previous items; source is updated when load finish
+                return self._last_items
+            # nothing to show yet; wait for background load
+            job.done.wait()
+            with self._refresh_lock:
+                if self._prefetch is job:
+                    self._prefetch = None
+        if job.leaves is None:
+            # background load failed
+            return self._load_items()
+        return job.leaves
+
+    def schedule_prefetch(self):
+        ''' Mark source as loaded in background; return False when load is
+        already scheduled. '''
+        with self._refresh_lock:
+            if self._prefetch is not None and not self._prefetch.done.is_set():
+                return False
+            self._prefetch = _Prefetch()
+            return True
+
+    def prefetch(self):
+        ''' Load items in background; they are returned by next get_items '''
+        job = self._prefetch
+        try:
+            job.leaves = list(self._load_items())
+        except Exception:
+            self.output_exc()
+        finally:
+            job.done.set()
+        gobject.idle_add(self._prefetch_finished)
+
+    def _prefetch_finished(self):
+        self.mark_for_update()
+        return False
+
+    def get_description(self):
+        return self.description
+
+    def _load_items(self):
+        stats = _RunStats()
         if self.command:
-            itms = self._get_items_from_cmd()
+            leaves = self._get_items_from_cmd(stats)
         elif os.path.isfile(self.filename):
-            itms = self._get_items_from_file()
+            leaves = self._get_items_from_file(stats)
         else:
             return
-        resclass = RESULT_CLASSES.get(self.result_type, objects.TextLeaf)
-        for itm in itms:
-            if itm:
-                obj = resclass(itm)
-                obj.source_name = self.name
-                yield obj
+        items = []
+        try:
+            for leaf in leaves:
+                items.append(leaf)
+                stats.items += 1
+                yield leaf
+        finally:
+            self._last_items = items
+            stats.finish()
+            self.stats = stats
+            self.output_debug('refreshed:', stats)
 
-    def get_description(self):
-        return self.description
-
-    def _get_items_from_cmd(self):
+    def _get_items_from_cmd(self, stats):
+        # Python 2 pipes are unbuffered by default; readline would read
+        # output byte by byte
+        proc = subprocess.Popen(
+            self.command, shell=True, stdout=subprocess.PIPE, bufsize=-1)
         if self.result_type == 'one-text':
-            proc = subprocess.Popen(
-                self.command, shell=True, stdout=subprocess.PIPE)
             out, _err = proc.communicate()
-            return (out, )
+            stats.bytes = len(out)
+            stats.exit_status = proc.returncode
+            return self._reuse_leaves((out, ))
 
-        proc = subprocess.Popen(
-            self.command, shell=True, stdout=subprocess.PIPE)
-        out, _err = proc.communicate()
-        return out.split('\n')
+        return self._reuse_leaves(_read_lines(proc, self.max_items, stats))
 
-    def _get_items_from_file(self):
-        if self.result_type == 'one-text':
-            with open(self.filename, 'r') as infile:
-                return (infile.read(), )
+    def _reuse_leaves(self, itms):
+        ''' Create leaves for command output lines; reuse leaves for
+        unchanged lines. Leaves are keyed by (line, occurrence of line) so
+        repeated lines get own leaves. '''
+        leaves = {}
+        occurrences = {}
+        try:
+            for itm in itms:
+                if not itm:
+                    continue
+                occurrence = occurrences.get(itm, 0)
+                occurrences[itm] = occurrence + 1
+                key = (itm, occurrence)
+                leaf = self._leaves.get(key)
+                if leaf is None:
+                    leaf = _create_leaf(itm, self.result_type, self.name)
+                    if leaf is None:
+                        continue
+                leaves[key] = leaf
+                yield leaf
+        finally:
+            self._leaves = leaves
+
+    def _get_items_from_file(self, stats):
+        ''' Read lines appended to file since last call; leaves are created
+        only for new lines '''
+        fstat = os.stat(self.filename)
+        stats.bytes = fstat.st_size
+        file_id = (fstat.st_dev, fstat.st_ino)
+        if file_id != self._file_id or fstat.st_size < self._file_offset:
+            # new, replaced or truncated file - read it from beginning
+            self._file_id = file_id
+            self._file_offset = 0
+            self._file_leaves = []
+            self._file_text = b''
+
+        with open(self.filename, 'rb') as infile:
+            if self.result_type == 'one-text':
+                infile.seek(self._file_offset)
+                data = infile.read(fstat.st_size - self._file_offset)
+                self._file_offset += len(data)
+                self._file_text += data
+                return list(_create_leaves((self._file_text, ),
+                                           self.result_type, self.name))
+
+            lines, self._file_offset, partial = _read_new_lines(
+                infile, self._file_offset, fstat.st_size)
+        self._file_leaves.extend(_create_leaves(lines, self.result_type,
+                                                self.name))
+        leaves = list(self._file_leaves)
+        if partial:
+            # last line is not finished yet; show it but read it again later
+            leaves.extend(_create_leaves((partial, ), self.result_type,
+                                         self.name))
+        return leaves
+
+
+class _RunStats(object):
+    ''' Statistics of source refresh '''
+
+    def __init__(self):
+        self.start = time.time()
+        self.elapsed = None
+        self.exit_status = None
+        self.items = 0
+        self.bytes = 0
+
+    def finish(self):
+        self.elapsed = time.time() - self.start
+
+    def __str__(self):
+        return _("%(time).2f s, exit status: %(status)s, %(items)d items, "
+                 "%(bytes)d bytes") % {
+                     'time': self.elapsed or 0.,
+                     'status': '-' if self.exit_status is None
+                               else self.exit_status,
+                     'items': self.items,
+                     'bytes': self.bytes}
+
+
+class _Prefetch(object):
+    ''' Background load of source items '''
+
+    def __init__(self):
+        self.done = threading.Event()
+        # loaded leaves; None when load failed
+        self.leaves = None
+
+
+class _RefreshCoordinator(object):
+    ''' Refresh sources in background on bounded pool of workers. '''
+
+    def __init__(self, workers):
+        self._workers = workers
+        self._pool = None
+
+    def refresh(self, sources):
+        if self._pool is None:
+            self._pool = ThreadPool(self._workers)
+        for src in sources:
+            if src.schedule_prefetch():
+                self._pool.apply_async(src.prefetch)
+
+
+_COORDINATOR = _RefreshCoordinator(_REFRESH_WORKERS)
+
+
+class _SourceStatusLeaf(objects.Leaf):
+    def __init__(self, src):
+        objects.Leaf.__init__(self, src.name, src.name)
+        self._stats = src.stats
+
+    def get_description(self):
+        if self._stats is None:
+            return _('Not refreshed yet')
+        return str(self._stats)
+
+    def get_icon_name(self):
+        return "dialog-information"
+
+
+class UserSourcesStatusSource(Source):
+    def __init__(self, sources):
+        Source.__init__(self, name=_('User Sources Status'))
+        self._sources = sources
+
+    def is_dynamic(self):
+        return True
+
+    def get_items(self):
+        for src in self._sources:
+            yield _SourceStatusLeaf(src)
+
+    def provides(self):
+        yield _SourceStatusLeaf
+
+
+class _QueryJob(object):
+    ''' One run of query command '''
+
+    def __init__(self, query):
+        self.query = query
+        self.done = threading.Event()
+        self.leaves = None
+        self.timer = None
+        self.proc = None
+
+
+class _QueryCommand(object):
+    ''' Command run for text query.
+
+    Command is started on worker thread after _QUERY_DEBOUNCE; process
+    started for older query is killed when newer query arrive. `run` waits
+    at most _QUERY_WAIT for results, so they are returned to the search for
+    entered text; results of slower commands are cached when ready and
+    returned when the text is searched again. Results are kept in LRU
+    cache. '''
 
-        with open(self.filename, 'r') as infile:
-            return (line.strip() for line in infile.readlines())
+    def __init__(self, name, command, result_type, max_items):
+        self.name = name
+        self.command = _query_shell_command(command)
+        self.result_type = result_type
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._job = None
+        self._cache = OrderedDict()
+
+    def run(self, query):
+        with self._lock:
+            leaves = self._cache.pop(query, None)
+            if leaves is not None:
+                self._cache[query] = leaves
+                return leaves
+            job = self._job
+            if job is None or job.query != query:
+                self._cancel()
+                job = self._job = _QueryJob(query)
+                job.timer = threading.Timer(_QUERY_DEBOUNCE, self._execute,
+                                            (job, ))
+                job.timer.daemon = True
+                job.timer.start()
+        job.done.wait(_QUERY_WAIT)
+        return job.leaves or []
+
+    def _execute(self, job):
+        query = job.query
+        if not isinstance(query, bytes):
+            query = query.encode('utf-8')
+        # query is passed as positional parameter ($1) so it is never
+        # interpreted by shell
+        args = ['/bin/sh', '-c', self.command, 'sh', query]
+        with self._lock:
+            if job is not self._job:
+                # newer query arrived
+                return
+            try:
+                # own process group, so whole shell pipeline can be killed
+                proc = job.proc = subprocess.Popen(
+                    args, stdout=subprocess.PIPE, bufsize=-1,
+                    preexec_fn=os.setsid)
+            except OSError as err:
+                pretty.print_error(__name__, 'running', self.command, err)
+                self._finish(job, None)
+                return
+            timeout = threading.Timer(_QUERY_TIMEOUT, _terminate, (proc, ))
+            timeout.daemon = True
+            timeout.start()
+
+        leaves = None
+        try:
+            if self.result_type == 'one-text':
+                itms = (proc.communicate()[0], )
+            else:
+                itms = _read_lines(proc, self.max_items)
+            leaves = list(_create_leaves(itms, self.result_type, self.name))
+            if proc.returncode == -signal.SIGKILL:
+                pretty.print_info(__name__, 'query command killed:',
+                                  self.command)
+                leaves = None
+        finally:
+            timeout.cancel()
+            with self._lock:
+                self._finish(job, leaves)
+
+    def _finish(self, job, leaves):
+        ''' Store results of `job`; must be called with lock held '''
+        if job is self._job:
+            self._job = None
+            if leaves is not None:
+                self._cache[job.query] = leaves
+                while len(self._cache) > _QUERY_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        job.leaves = leaves
+        job.done.set()
+
+    def _cancel(self):
+        ''' Cancel current job; must be called with lock held '''
+        job, self._job = self._job, None
+        if job is None:
+            return
+        if job.timer is not None:
+            job.timer.cancel()
+        if job.proc is not None:
+            _terminate(job.proc)
+        job.done.set()
+
+
+def _query_shell_command(command):
+    ''' Replace query placeholder (also quoted) in `command` by first
+    positional parameter of shell '''
+    for placeholder in ("'%s'" % _QUERY_PLACEHOLDER,
+                        '"%s"' % _QUERY_PLACEHOLDER, _QUERY_PLACEHOLDER):
+        command = command.replace(placeholder, '"$1"')
+    return command
+
+
+def _terminate(proc):
+    ''' Kill process group of `proc` '''
+    if proc.poll() is None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+class _RecordLeafMixin(object):
+    ''' Leaf created from structured record; may have own description '''
+    record_description = None
+
+    def get_description(self):
+        return (self.record_description or
+                super(_RecordLeafMixin, self).get_description())
+
+
+class _RecordTextLeaf(_RecordLeafMixin, objects.TextLeaf):
+    pass
+
+
+class _RecordUrlLeaf(_RecordLeafMixin, objects.UrlLeaf):
+    pass
+
+
+class _RecordFileLeaf(_RecordLeafMixin, objects.FileLeaf):
+    pass
+
+
+RECORD_CLASSES = {
+    'url': _RecordUrlLeaf,
+    'file': _RecordFileLeaf,
+    'text': _RecordTextLeaf,
+}
+
+
+def _create_leaves(itms, result_type, source_name):
+    for itm in itms:
+        if itm:
+            leaf = _create_leaf(itm, result_type, source_name)
+            if leaf is not None:
+                yield leaf
+
+
+def _create_leaf(itm, result_type, source_name):
+    ''' Create leaf for line `itm`; return None for invalid record. '''
+    if result_type in STRUCTURED_TYPES:
+        leaf = _create_record_leaf(itm, result_type)
+        if leaf is None:
+            return None
+    else:
+        leaf = RESULT_CLASSES.get(result_type, objects.TextLeaf)(itm)
+    leaf.source_name = source_name
+    return leaf
+
+
+def _create_record_leaf(itm, result_type):
+    try:
+        rtype, obj, name, description = _parse_record(itm, result_type)
+    except ValueError as err:
+        pretty.print_debug(__name__, 'invalid record', itm, err)
+        return None
+    if not obj:
+        return None
+    leaf = RECORD_CLASSES.get(rtype, _RecordTextLeaf)(obj, name or None)
+    leaf.record_description = description
+    return leaf
+
+
+def _parse_record(line, result_type):
+    ''' Parse line of structured output.
+    Return (type, object, name, description); raise ValueError on invalid
+    line. '''
+    if result_type == 'jsonl':
+        record = json.loads(line)
+        if not isinstance(record, dict):
+            raise ValueError('record is not object')
+        fields = (record.get('type'), record.get('object'),
+                  record.get('name'), record.get('description'))
+        for field in fields:
+            if field is not None and not isinstance(field, _STRING_TYPES):
+                raise ValueError('record field is not string: %r' % (field, ))
+        return fields
+
+    fields = line.split('\t', 3)
+    fields.extend([None] * (4 - len(fields)))
+    return tuple(fields)
+
+
+def _read_lines(proc, max_items=None, stats=None):
+    ''' Yield non-empty lines from `proc` stdout as soon as they arrive.
+    Process is terminated after `max_items` lines or when caller stop
+    reading. Read bytes and exit status are stored in `stats`. '''
+    count = 0
+    try:
+        for line in iter(proc.stdout.readline, b''):
+            if stats is not None:
+                stats.bytes += len(line)
+            line = line.rstrip(b'\r\n')
+            if not line:
+                continue
+            yield line
+            count += 1
+            if max_items and count >= max_items:
+                break
+    finally:
+        if proc.poll() is None:
+            proc.terminate()
+        proc.stdout.close()
+        proc.wait()
+        if stats is not None:
+            stats.exit_status = proc.returncode
+
+
+def _read_new_lines(infile, offset, size):
+    ''' Read complete lines from `infile` between `offset` and `size`.
+    Return list of non-empty lines, offset after last complete line and
+    unfinished last line. '''
+    if size - offset >= _MMAP_THRESHOLD:
+        buf = mmap.mmap(infile.fileno(), size, access=mmap.ACCESS_READ)
+        pos = offset
+    else:
+        infile.seek(offset)
+        buf = infile.read(size - offset)
+        pos = 0
+    base = offset - pos
+    lines = []
+    try:
+        while True:
+            end = buf.find(b'\n', pos)
+            if end < 0:
+                break
+            line = buf[pos:end].strip()
+            if line:
+                lines.append(line)
+            pos = end + 1
+        partial = buf[pos:].strip()
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+    return lines, base + pos, partial
 
 
 _ACTION_DEFAULTS = {
@@ -109,39 +652,161 @@ _ACTION_DEFAULTS = {
     'file': None,
     'dynamic': False,
     'description': None,
+    'max_items': None,
 }
 
 
+def _config_file():
+    config_file = config.get_config_file(CONFIG_FILENAME)
+    if config_file and os.path.isfile(config_file):
+        return config_file
+    return None
+
+
+def _load_config(config_file):
+    ''' Load sources definitions; return list of (section, options) '''
+    cfgpars = ConfigParser.SafeConfigParser(_ACTION_DEFAULTS)
+    cfgpars.read(config_file)
+    return [(section, dict((key, cfgpars.get(section, key))
+                           for key in _ACTION_DEFAULTS))
+            for section in cfgpars.sections()]
+
+
+def _get_max_items(options):
+    max_items = options['max_items']
+    return int(max_items) if max_items else None
+
+
+def _section_digest(options):
+    return hash(tuple(sorted(options.items())))
+
+
+def _is_query_command(options):
+    command = options['command']
+    return bool(command) and _QUERY_PLACEHOLDER in command
+
+
 class UserSourcesSource(Source, FilesystemWatchMixin):
     def __init__(self):
         Source.__init__(self, name=_('User Sources'))
+        # section name -> (section digest, UserSource)
+        self._sources = {}
 
     def initialize(self):
         config_home = config.get_config_paths().next()
         self.monitor_token = self.monitor_directories(config_home)
 
+    def finalize(self):
+        self._finalize_sources(self._sources, {})
+        self._sources = {}
+
     def monitor_include_file(self, gfile):
         return gfile and gfile.get_basename() == CONFIG_FILENAME
 
     def get_items(self):
-        _config_file = config.get_config_file('user_sources.cfg')
-        if not _config_file or not os.path.isfile(_config_file):
+        config_file = _config_file()
+        if not config_file:
             self.output_debug('no config file')
+            self._finalize_sources(self._sources, {})
+            self._sources = {}
             return
 
-        self.output_debug('loading sources', _config_file)
+        self.output_debug('loading sources', config_file)
 
-        cfgpars = ConfigParser.SafeConfigParser(_ACTION_DEFAULTS)
-        cfgpars.read(_config_file)
-        for section in cfgpars.sections():
-            command = cfgpars.get(section, 'command')
-            filename = cfgpars.get(section, 'file')
+        sources = OrderedDict()
+        created = []
+        for section, options in _load_config(config_file):
+            command = options['command']
+            filename = options['file']
             if not command and not filename:
                 self.output_info('missing command and filename for source:',
                                  section)
                 continue
+            if _is_query_command(options):
+                continue
+            digest = _section_digest(options)
+            old = self._sources.get(section)
+            if old and old[0] == digest:
+                # unchanged section; keep source and its cached items
+                sources[section] = old
+                continue
+            self.output_debug('creating source', section)
             src = UserSource(section, command, filename)
-            src.result_type = cfgpars.get(section, 'type') or 'text'
-            src.description = cfgpars.get(section, 'description')
-            src.dynamic = bool(cfgpars.get(section, 'dynamic'))
+            src.result_type = options['type'] or 'text'
+            src.description = options['description']
+            src.dynamic = bool(options['dynamic'])
+            try:
+                src.max_items = _get_max_items(options)
+            except ValueError:
+                self.output_info('invalid max_items for source:', section)
+            sources[section] = (digest, src)
+            if not src.dynamic:
+                created.append(src)
+
+        self._finalize_sources(self._sources, sources)
+        self._sources = sources
+        _COORDINATOR.refresh(created)
+        for _digest, src in sources.values():
             yield objects.SourceLeaf(src)
+        yield objects.SourceLeaf(UserSourcesStatusSource(
+            [src for _digest, src in sources.values()]))
+
+    def _finalize_sources(self, old_sources, sources):
+        ''' Stop sources from `old_sources` removed or replaced in
+        `sources` '''
+        for section, (_digest, src) in old_sources.items():
+            new = sources.get(section)
+            if new is None or new[1] is not src:
+                self.output_debug('removing source', section)
+                src.finalize()
+
+
+class UserQuerySource(TextSource):
+    def __init__(self):
+        TextSource.__init__(self, name=_('User Query Sources'))
+        self._config_mtime = None
+        # section name -> (section digest, _QueryCommand)
+        self._commands = {}
+
+    def get_text_items(self, text):
+        text = text.strip()
+        if not text:
+            return
+        for _digest, command in self._get_commands():
+            for leaf in command.run(text):
+                yield leaf
+
+    def _get_commands(self):
+        config_file = _config_file()
+        if not config_file:
+            self._config_mtime = None
+            self._commands = {}
+            return []
+
+        mtime = os.path.getmtime(config_file)
+        if mtime != self._config_mtime:
+            self.output_debug('loading query commands', config_file)
+            self._config_mtime = mtime
+            self._commands = self._load_commands(config_file)
+        return self._commands.values()
+
+    def _load_commands(self, config_file):
+        commands = {}
+        for section, options in _load_config(config_file):
+            if not _is_query_command(options):
+                continue
+            digest = _section_digest(options)
+            old = self._commands.get(section)
+            if old and old[0] == digest:
+                # unchanged command; keep its results cache
+                commands[section] = old
+                continue
+            try:
+                max_items = _get_max_items(options)
+            except ValueError:
+                self.output_info('invalid max_items for source:', section)
+                max_items = None
+            commands[section] = (digest, _QueryCommand(
+                section, options['command'], options['type'] or 'text',
+                max_items))
+        return commands
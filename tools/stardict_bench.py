@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+''' Benchmark of StarDict plugin lookup path.
+
+Generate synthetic StarDict dictionaries (.ifo, .idx, .idx.gz, .dict,
+.dict.dz) and measure lookups done by the plugin (stardict._lookup with
+its dictionaries and results caches). Kupfer and pyStarDict must be
+importable, like when the plugin is loaded; run the tool with the same
+Python interpreter as Kupfer. Results are printed as JSON.
+
+Usage:
+	stardict_bench.py [--sizes 10000,100000,1000000] [--lookups 1000]
+		[--workdir DIR] [--output FILE]
+
+Measured for each dictionary size and files variant (dict, dict.dz,
+idx.gz - read by pyStarDict):
+	open_cold: first lookup without index cache (dictionary is opened and
+		index is built)
+	open_cached: first lookup with index cache
+	lookup_p50, lookup_p99: _lookup of opened dictionary (sec)
+	cached_p50, cached_p99: repeated lookup served by results cache (sec)
+	suggest_open: time until dictionary is opened for suggestions in
+		background (sec; only for dictionaries read directly)
+	prefix_p50, prefix_p99: suggestions for 3 letters prefix (sec; only for
+		dictionaries read directly)
+	rss_delta: resident memory grow after open and lookups with index
+		cache (bytes)
+'''
+from __future__ import print_function
+
+__version__ = "2026-10-19"
+__author__ = "Karol Będkowski <karol.bedkowski@gmail.com>"
+
+import argparse
+import gc
+import gzip
+import json
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+_WORKDIR = tempfile.mkdtemp(prefix='stardict-bench-')
+# index cache of plugin is kept in kupfer cache directory
+os.environ['XDG_CACHE_HOME'] = os.path.join(_WORKDIR, 'cache')
+# gettext function is installed by kupfer on start
+if not hasattr(builtins, '_'):
+    builtins._ = lambda text: text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'plugins'))
+
+import stardict  # noqa: E402
+import stardict_support as support  # noqa: E402
+
+DICTZIP_CHUNK_LEN = 58315
+_LETTERS = u'abcdefghijklmnopqrstuvwxyzéöß'
+_SETTINGS = {'dictdirs': '', 'cache_size': 4, 'suggest': False}
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+def generate_words(count, seed=0):
+    ''' Generate `count` unique pseudo-random words '''
+    rnd = random.Random(seed)
+    words = set()
+    while len(words) < count:
+        length = rnd.randint(3, 12)
+        word = u''.join(rnd.choice(_LETTERS) for _ in range(length))
+        if rnd.random() < 0.1:
+            word = word.capitalize()
+        words.add(word)
+    return sorted((word.encode('utf-8') for word in words),
+                  key=lambda word: (word.lower(), word))
+
+
+def write_dictionary(path, words):
+    ''' Write .ifo, .idx and .dict files for `words` '''
+    offset = 0
+    with open(path + '.idx', 'wb') as idx, open(path + '.dict', 'wb') as data:
+        for word in words:
+            article = (b'<b>' + word + b'</b><br>definition of ' + word +
+                       b' &amp; <i>example</i>')
+            data.write(article)
+            idx.write(word + b'\0' + struct.pack('>II', offset, len(article)))
+            offset += len(article)
+        idxsize = idx.tell()
+    with open(path + '.ifo', 'w') as ifo:
+        ifo.write("StarDict's dict ifo file\nversion=2.4.2\n")
+        ifo.write("bookname=Benchmark %d\n" % len(words))
+        ifo.write("wordcount=%d\nidxfilesize=%d\n" % (len(words), idxsize))
+        ifo.write("sametypesequence=h\n")
+
+
+def write_dictzip(src, dst, chunk_len=DICTZIP_CHUNK_LEN):
+    ''' Compress `src` into dictzip file `dst` '''
+    with open(src, 'rb') as infile:
+        data = infile.read()
+    chunks = []
+    for start in range(0, len(data), chunk_len):
+        comp = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        last = start + chunk_len >= len(data)
+        chunks.append(comp.compress(data[start:start + chunk_len]) +
+                      comp.flush(zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH))
+    rafield = struct.pack('<HHH', 1, chunk_len, len(chunks)) + \
+        b''.join(struct.pack('<H', len(chunk)) for chunk in chunks)
+    extra = b'RA' + struct.pack('<H', len(rafield)) + rafield
+    with open(dst, 'wb') as outfile:
+        # magic, deflate, FEXTRA, mtime, xfl, os (unix)
+        outfile.write(b'\x1f\x8b\x08\x04\0\0\0\0\x02\x03')
+        outfile.write(struct.pack('<H', len(extra)) + extra)
+        for chunk in chunks:
+            outfile.write(chunk)
+        outfile.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+                                  len(data) & 0xffffffff))
+
+
+def write_gzip(src, dst):
+    ''' Compress `src` into gzip file `dst` '''
+    with open(src, 'rb') as infile, gzip.open(dst, 'wb') as outfile:
+        shutil.copyfileobj(infile, outfile)
+
+
+def _rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def _percentile(values, perc):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * perc / 100.))]
+
+
+def _timeit(func, *args):
+    start = _timer()
+    result = func(*args)
+    return _timer() - start, result
+
+
+def _reset_plugin_caches():
+    ''' Close dictionaries opened by plugin and forget lookup results '''
+    stardict._DICTIONARIES = stardict._DictionaryCache()
+    stardict._RESULTS = stardict._ResultsCache()
+    stardict._SUGGEST_DICTIONARIES = stardict._SuggestDictionaries()
+    gc.collect()
+
+
+def _prefix(dictionary, prefix):
+    # like SuggestionsSource.get_text_items
+    prefix = prefix.encode('utf-8')
+    return [sdict.suggest(prefix, stardict._SUGGESTIONS_LIMIT)
+            for _dictionary, sdict
+            in stardict._SUGGEST_DICTIONARIES.get_all([dictionary])]
+
+
+def _wait_suggestions(dictionary):
+    ''' Wait until dictionary is opened for suggestions in background '''
+    while not stardict._SUGGEST_DICTIONARIES.get_all([dictionary]):
+        time.sleep(0.001)
+
+
+def bench_dictionary(path, words, lookups):
+    ''' Measure lookups in dictionary `path` by the plugin '''
+    rnd = random.Random(1)
+    # plugin looks up text entered by user
+    sample = [rnd.choice(words).decode('utf-8') for _ in range(lookups)]
+    prefixes = [word[:3] for word in sample]
+    dictionary = stardict.Dictionary(path, os.path.basename(path))
+    shutil.rmtree(os.environ['XDG_CACHE_HOME'], ignore_errors=True)
+    os.makedirs(os.path.join(os.environ['XDG_CACHE_HOME'], 'stardict'))
+
+    _reset_plugin_caches()
+    open_cold = _timeit(stardict._lookup, path, sample[0])[0]
+    # drop cold instance; memory is measured for opening with index cache
+    _reset_plugin_caches()
+    rss_before = _rss()
+    open_cached = _timeit(stardict._lookup, path, sample[0])[0]
+    lookup_times = [_timeit(stardict._lookup, path, word)[0]
+                    for word in sample]
+    for word in sample:
+        stardict._RESULTS.get(dictionary, word)
+    cached_times = [_timeit(stardict._RESULTS.get, dictionary, word)[0]
+                    for word in sample]
+    result = {
+        'open_cold': open_cold,
+        'open_cached': open_cached,
+        'lookup_p50': _percentile(lookup_times, 50),
+        'lookup_p99': _percentile(lookup_times, 99),
+        'cached_p50': _percentile(cached_times, 50),
+        'cached_p99': _percentile(cached_times, 99),
+    }
+    if support.can_open(path):
+        result['suggest_open'] = _timeit(_wait_suggestions, dictionary)[0]
+        prefix_times = [_timeit(_prefix, dictionary, prefix)[0]
+                        for prefix in prefixes]
+        result['prefix_p50'] = _percentile(prefix_times, 50)
+        result['prefix_p99'] = _percentile(prefix_times, 99)
+    result['rss_delta'] = _rss() - rss_before
+    _reset_plugin_caches()
+    return result
+
+
+def run(sizes, lookups, workdir):
+    stardict.__kupfer_settings__ = _SETTINGS
+    results = []
+    for size in sizes:
+        words = generate_words(size)
+        dictdir = os.path.join(workdir, str(size))
+        if not os.path.isdir(dictdir):
+            os.makedirs(dictdir)
+        path = os.path.join(dictdir, 'bench')
+        write_dictionary(path, words)
+        for variant in ('dict', 'dict.dz', 'idx.gz'):
+            if variant == 'dict.dz':
+                write_dictzip(path + '.dict', path + '.dict.dz')
+                os.remove(path + '.dict')
+            elif variant == 'idx.gz':
+                write_gzip(path + '.idx', path + '.idx.gz')
+                os.remove(path + '.idx')
+            result = bench_dictionary(path, words, lookups)
+            result.update({'headwords': size, 'data': variant})
+            results.append(result)
+            print(json.dumps(result), file=sys.stderr)
+    return {
+        'version': __version__,
+        'python': sys.version.split()[0],
+        'lookups': lookups,
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help='comma separated numbers of headwords')
+    parser.add_argument('--lookups', type=int, default=1000,
+                        help='number of measured lookups')
+    parser.add_argument('--workdir', help='directory for dictionaries '
+                        '(default: temporary directory)')
+    parser.add_argument('--output', help='write results to file')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    try:
+        report = run(sizes, args.lookups, args.workdir or _WORKDIR)
+    finally:
+        shutil.rmtree(_WORKDIR, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            outfile.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()